@@ -5,154 +5,1163 @@
 #
 # Distributed under terms of the MIT license.
 from __future__ import print_function
-import gevent
-from gevent import monkey
-monkey.patch_all()
+import asyncio
+import aiohttp
 import requests
-from bs4 import *
 import os
+import sys
 from collections import namedtuple
 
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 from time import mktime, time
 import re
-import numpy as np
-from gevent.pool import Pool
-import requests
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import bz2index
+import dumpcache
 # Python 2/3 compatible
-try:
-    from urllib import urlretrieve
-except ImportError:
-    from urllib.request import urlretrieve
 try:
     from urlparse import urljoin, urlsplit
 except ImportError:
     from urllib.parse import urljoin, urlsplit
 
 
-def prepare_wiki_url(lang):
-    """分析 WikiMedia 網站，傳回要下載的檔案清單，包含日期及大小。
-    日期及大小會用來核對檔案是否需要重新下載，只要日期或大小不同，就會重新下載。
+dump_host = 'https://dumps.wikimedia.org/'   # 測試時可以換成本機的 HTTP server
+# 其他和 dump_host 目錄結構相同的 mirror，例如 'https://dumps.wikimedia.your.org/'。
+# manifest 一律從 dump_host 讀取，檔案則可以從任何一個 mirror 下載。
+mirrors = []
+manifest_dir = '.manifest'   # dumpstatus.json 等檔案的快取，配合 ETag/If-Modified-Since 使用
 
-    'href': 要下載的檔案名稱 (副檔名應為 bz2)
-    'date': 檔案在server上的日期
-    'size': 檔案大小
-    """
+# manifest 裡每個檔案的資訊
+# 'url': 下載網址
+# 'filename': 檔名
+# 'size': 檔案大小
+# 'date': 檔案在 server 上的日期
+# 'md5', 'sha1': server 公布的 hash，不知道時為 None
+# 'index': multistream 檔案對應的 index 檔網址，其他為 None
+DumpFile = namedtuple('DumpFile', ['url', 'filename', 'size', 'date', 'md5', 'sha1', 'index'])
+
+# prepare_wiki_url 傳回的下載工作
+Download = namedtuple('Download', ['url', 'lang', 'date', 'size', 'path', 'filename', 'number',
+                                   'md5', 'sha1'])
 
-    base_url = 'https://dumps.wikimedia.org/{}wiki/latest/'.format(lang)
 
+def cached_get(url, immutable=False):
+    """用 conditional request 取得 url 的內容，沒有變動時直接用快取。
+    immutable=True 表示內容不會再變 (例如已完成的 dump)，有快取就不連線。
+    """
+    cache = os.path.join(manifest_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
     try:
-        html = requests.get(base_url).content
-    except Exception as e:
-        exit(1)  # 如果連網路都連不上，就不用作下去了
+        with open(cache) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        cached = None
+    if cached and immutable:
+        return cached['body']
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    r = session.get(url, headers=headers, timeout=60)
+    if r.status_code == 304:
+        return cached['body']
+    r.raise_for_status()
+
+    if not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(cache + '.tmp', 'w') as f:
+        json.dump({'url': url, 'etag': r.headers.get('ETag'),
+                   'last_modified': r.headers.get('Last-Modified'), 'body': r.text}, f)
+    os.rename(cache + '.tmp', cache)
+    return r.text
+
+
+def latest_dump_date(lang):
+    """latest/ 的 sha1sums 檔裡的檔名帶有日期，用它找出最新一次 dump 的日期"""
+    url = urljoin(dump_host, '{0}wiki/latest/{0}wiki-latest-sha1sums.txt'.format(lang))
+    m = re.search(r'{}wiki-(\d{{8}})-'.format(lang), cached_get(url))
+    if not m:
+        raise ValueError('no dump date in {}'.format(url))
+    return m.group(1)
+
 
+def load_manifest(lang, date=None, multistream=False):
+    """讀取 dump 的 dumpstatus.json，傳回 pages-articles 檔案的 DumpFile 清單。
+    date 為 None 時使用最新的 dump。
+    """
+    date = date or latest_dump_date(lang)
+    url = urljoin(dump_host, '{}wiki/{}/dumpstatus.json'.format(lang, date))
+    name = 'articlesmultistreamdump' if multistream else 'articlesdump'
+    # 已經完成的 dump 不會再變動，有快取就不必連線
+    job = json.loads(cached_get(url, immutable=True))['jobs'][name]
+    if job['status'] != 'done':
+        job = json.loads(cached_get(url))['jobs'][name]
+    if job['status'] != 'done':
+        raise ValueError('{} dump of {} is {}'.format(lang, date, job['status']))
+    updated = dt.strptime(job['updated'], '%Y-%m-%d %H:%M:%S')
+
+    names = list(job['files'])
+    indexes = {}
+    for name in names:
+        # xxwiki-...-multistream-index1.txt-p1p41242.bz2 對應 xxwiki-...-multistream1.xml-p1p41242.bz2
+        if re.search(r'multistream-index\d*\.txt', name):
+            key = re.sub(r'multistream-index(\d*)\.txt', r'multistream\1.xml', name)
+            indexes[key] = urljoin(dump_host, job['files'][name]['url'])
+    # 我們只要抓檔名中包含 pages-articles 的檔案，有分割的話只要分割檔
+    articles = [n for n in names if re.search(r'pages-articles(-multistream)?\d.*\.bz2$', n)]
+    if not articles:
+        articles = [n for n in names if re.search(r'pages-articles(-multistream)?\.xml\.bz2$', n)]
+    return [DumpFile(urljoin(dump_host, job['files'][n]['url']), n, job['files'][n]['size'],
+                     updated, job['files'][n].get('md5'), job['files'][n].get('sha1'),
+                     indexes.get(n))
+            for n in articles]
+
+
+def scrape_manifest(lang):
+    """沒有 dumpstatus.json 時，改為分析 latest/ 的 HTML 列表"""
+    from bs4 import BeautifulSoup
+
+    base_url = urljoin(dump_host, '{}wiki/latest/'.format(lang))
+    html = session.get(base_url, timeout=60).content
     bhtml = BeautifulSoup(html, 'lxml')
     # 我們只要抓檔名中包含 pages-articles 的檔案
     articles = bhtml.find_all('a', {'href': re.compile(r'.*pages-articles\d.*bz2$')})
     if len(articles) == 0:
         articles = bhtml.find_all('a', {'href': re.compile(r'.*pages-articles\.xml\.bz2$')})
-    date_time_size = [tag.next.next.split() for tag in articles]
-
-    href = np.array([urljoin(base_url, tag['href']) for tag in articles], dtype=np.str)
-    date = np.array([dt.strptime(date + ' ' + time, '%d-%b-%Y %H:%M')
-                     for date, time, _ in date_time_size])
-    size = np.array([int(size) for _, _, size in date_time_size], dtype=np.int64)
-
-    # 同名檔案會包含一個 xml 檔及一個 bz2，我們只需要抓 bz2
-    if sum(size <= 100000):
-        href = href[size > 100000]
-        date = date[size > 100000]
-        size = size[size > 100000]
+    sums = fetch_checksums(base_url, lang)
+
+    files = []
+    for tag in articles:
+        day, hour, size = tag.next.next.split()
+        size = int(size)
+        # 同名檔案會包含一個 xml 檔及一個 bz2，我們只需要抓 bz2
+        if size <= 100000:
+            continue
+        url = urljoin(base_url, tag['href'])
+        filename = urlsplit(url).path.split('/')[-1]
+        files.append(DumpFile(url, filename, size, dt.strptime(day + ' ' + hour, '%d-%b-%Y %H:%M'),
+                              sums.get(filename, {}).get('md5'),
+                              sums.get(filename, {}).get('sha1'), None))
+    return files
+
+
+def prepare_wiki_url(lang, date=None, multistream=False):
+    """傳回要下載的檔案清單 (Download)，包含日期、大小及 hash。
+    檔案清單來自 dump 的 dumpstatus.json，拿不到時才分析 latest/ 的 HTML。
+    已經下載並驗證過 (記錄在 ledger 裡) 的檔案不會再下載。
+    """
+    try:
+        files = load_manifest(lang, date, multistream)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        if date or multistream:
+            raise
+        print('Cannot load dumpstatus.json ({}), scraping the HTML index'.format(e),
+              file=sys.stderr)
+        try:
+            files = scrape_manifest(lang)
+        except requests.RequestException:
+            exit(1)  # 如果連網路都連不上，就不用作下去了
+
     # 用檔案大小排序，方便作 multi-processing
-    descOrder = np.argsort(size)[::-1]
-    href = href[descOrder]
-    date = date[descOrder]
-    size = size[descOrder]
+    files.sort(key=lambda f: f.size, reverse=True)
 
-    filenames = np.array([urlsplit(url).path.split('/')[-1] for url in href])
     try:
-        numbers = [re.findall('articles(\d+).xml', fn)[0] for fn in filenames]
+        numbers = [re.findall(r'articles(?:-multistream)?(\d+).xml', f.filename)[0] for f in files]
     except IndexError:
         #如果檔案有articles.xml...的格式，沒有含任何數字
-        print('No numbers found in filenames. Creating numbers.')
-        numbers = list(range(len(filenames)))
+        print('No numbers found in filenames. Creating numbers.', file=sys.stderr)
+        numbers = [str(i) for i in range(len(files))]
     for i in range(len(numbers) - 1, -1, -1):
         if numbers[:i].count(numbers[i]):
             numbers[i] += '-' + str(numbers[:i].count(numbers[i]))
-    numbers = np.array(numbers)
-    paths = np.array([os.path.join(lang, fn) for fn in filenames])
 
-    if not os.path.isdir(lang):  # 如果連目錄都沒有建，全部都需要下載
+    if not os.path.isdir(lang):
         os.mkdir(lang)
-        return zip(href, [lang] * len(articles), date, size, paths, filenames, numbers)
+    # 已經驗證過的檔案記錄在 ledger 裡，只要檔案沒被動過就直接相信，不必重新計算 hash
+    ledger = load_ledger(lang)
+    infos = []
+    for f, number in zip(files, numbers):
+        path = os.path.join(lang, f.filename)
+        if not is_verified(path, f.date, f.size, f.md5, f.sha1, ledger):
+            infos.append(Download(f.url, lang, f.date, f.size, path, f.filename, number,
+                                  f.md5, f.sha1))
+    return infos
+
+
+def prepare_incr_url(lang, date=None):
+    """傳回每日 adds-changes (incremental) dump 的下載工作。
+    date 為 None 時，從昨天開始往前找最近一個已完成的。
+    """
+    if date:
+        dates = [date]
+    else:
+        dates = [(dt.utcnow() - timedelta(days=i)).strftime('%Y%m%d') for i in range(1, 8)]
+    for day in dates:
+        base_url = urljoin(dump_host, 'other/incr/{}wiki/{}/'.format(lang, day))
+        try:
+            status = session.get(base_url + 'status.txt', timeout=60)
+        except requests.RequestException:
+            continue
+        if status.status_code != 200 or status.text.strip() != 'done':
+            continue
+        filename = '{}wiki-{}-pages-meta-hist-incr.xml.bz2'.format(lang, day)
+        r = session.head(base_url + filename, timeout=60)
+        r.raise_for_status()
+        md5 = None
+        try:
+            for line in cached_get(base_url + '{}wiki-{}-md5sums.txt'.format(lang, day),
+                                   immutable=True).splitlines():
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == filename:
+                    md5 = fields[0]
+        except requests.RequestException:
+            pass
+        return Download(base_url + filename, lang, dt.strptime(day, '%Y%m%d'),
+                        int(r.headers['Content-Length']), os.path.join(lang, 'incr', filename),
+                        filename, day, md5, None)
+    raise ValueError('no finished incremental dump of {} for {}'.format(lang, ', '.join(dates)))
+
+
+def fetch_checksums(base_url, lang):
+    """讀取 dump 目錄裡的 md5sums/sha1sums，傳回 {檔名: {'md5': ..., 'sha1': ...}}。
+    latest/ 目錄裡的檔名是 xxwiki-latest-...，但 sums 檔裡寫的是有日期的檔名，要換回來。
+    """
+    sums = {}
+    dated = re.compile(r'^{}wiki-\d{{8}}-'.format(lang))
+    for algo in ('md5', 'sha1'):
+        url = urljoin(base_url, '{}wiki-latest-{}sums.txt'.format(lang, algo))
+        try:
+            text = cached_get(url)
+        except requests.RequestException as e:
+            print('Cannot fetch {}: {}'.format(url, e), file=sys.stderr)
+            continue
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            digest, name = fields
+            name = dated.sub('{}wiki-latest-'.format(lang), name)
+            sums.setdefault(name, {})[algo] = digest
+    return sums
+
+
+def ledger_path(lang):
+    return os.path.join(lang, 'ledger.json')
+
 
-    to_download = np.array([not os.path.isfile(fn) or  # the file doesn't exist
-                            dt.fromtimestamp(os.stat(fn).st_mtime) != day or  # the date's wrong
-                            os.stat(fn).st_size != sz  # the size's wrong
-                            for day, sz, fn in zip(date, size, paths)])
-    href = href[to_download]
-    date = date[to_download]
-    size = size[to_download]
-    paths = paths[to_download]
-    filenames = filenames[to_download]
-    numbers = numbers[to_download]
+def load_ledger(lang):
+    """ledger 記錄每個驗證過的檔案: {檔名: {'size', 'mtime', 'md5', 'sha1'}}"""
+    try:
+        with open(ledger_path(lang)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def record_ledger(lang, filename, entry):
+    ledger = load_ledger(lang)
+    if entry is None:
+        ledger.pop(filename, None)
+    else:
+        ledger[filename] = entry
+    tmp = ledger_path(lang) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(ledger, f, indent=1, sort_keys=True)
+    os.rename(tmp, ledger_path(lang))
+
+
+def is_verified(path, day, size, md5, sha1, ledger):
+    """檔案存在、下載完成、日期及大小正確，而且 ledger 裡的 hash 和 server 公布的相同"""
+    if not os.path.isfile(path) or os.path.isfile(part_path(path)):
+        return False
+    st = os.stat(path)
+    if dt.fromtimestamp(st.st_mtime) != day or st.st_size != size:
+        return False
+    entry = ledger.get(os.path.basename(path))
+    if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+        return False
+    return (md5 is None or entry['md5'] == md5) and (sha1 is None or entry['sha1'] == sha1)
 
-    return list(zip(href, [lang] * len(articles), date, size, paths, filenames, numbers))
 
+# 下載過程的記錄 (telemetry)
+telemetry_interval = 1.0   # 每隔幾秒更新一次
+events_path = None         # 輸出 newline-delimited JSON 事件的檔案，'-' 表示 stdout
+prom_path = None           # Prometheus node_exporter textfile collector 的 .prom 檔
+show_progress = sys.stderr.isatty()   # 是否在終端機顯示進度列 (寫到 stderr)
+
+
+class Telemetry(object):
+    """記錄每個檔案及全部的下載量、速度、ETA、retry 及 stall 次數。
+
+    每隔 telemetry_interval 秒輸出一次：JSON 事件 (events_path)、Prometheus textfile
+    (prom_path) 及終端機的進度列 (show_progress)，沒有開啟的輸出完全不會計算。
+    給人看的訊息都寫到 stderr，stdout 只留給 events_path 為 '-' 時的 JSON 事件。
+    下載中只會累加 Transfer.received 等計數，其他的都在這裡定時計算。
+    """
+
+    def __init__(self, events=None, prom=None, progress=None):
+        events = events or events_path
+        self.events = None
+        if events == '-':
+            self.events = sys.stdout
+        elif events:
+            self.events = open(events, 'a')
+        self.prom = prom or prom_path
+        self.progress = show_progress if progress is None else progress
+        self.transfers = []
+        self.connections = 0
+        self.st_time = time()
 
-download_log = dict()
-Log = namedtuple('Log', ['size_mb', 'last_mb', 'duration', 'speed', 'percent', 'st_time', 'last_time'])
+    def event(self, kind, **fields):
+        if self.events:
+            fields.update(event=kind, time=time())
+            self.events.write(json.dumps(fields, sort_keys=True) + '\n')
+            self.events.flush()
 
+    def start(self, transfer):
+        transfer.speed = 0.0
+        transfer.last_bytes = transfer.received
+        transfer.last_change = time()
+        self.transfers.append(transfer)
+        self.event('start', file=transfer.info.filename, size=transfer.size,
+                   bytes=transfer.received)
 
-def gen_download_hook(number):
-    def download_hook(count, block_size, total_size):
-        self_log = download_log[number]
-        if time() - self_log.last_time < 0.1:
+    def retry(self, transfer, url, error, stalled):
+        transfer.retries += 1
+        transfer.stalls += stalled
+        print('\n[{}] retry: {!r}'.format(url, error), file=sys.stderr)
+        self.event('stall' if stalled else 'retry', file=transfer.info.filename, url=url,
+                   error=repr(error))
+
+    def finish(self, transfer):
+        duration = max((dt.now() - transfer.st_time).total_seconds(), 1e-3)
+        if transfer in self.transfers:
+            self.transfers.remove(transfer)
+        print("\n[{}] finished, average speed = {:.2f} MB/s".format(
+            transfer.info.filename, transfer.size / 1024.0 / 1024.0 / duration), file=sys.stderr)
+        self.event('finish', file=transfer.info.filename, size=transfer.size,
+                   seconds=duration, retries=transfer.retries, stalls=transfer.stalls)
+
+    def update(self, interval):
+        now = time()
+        for t in self.transfers:
+            speed = (t.received - t.last_bytes) / interval
+            t.speed = speed if not t.speed else 0.7 * t.speed + 0.3 * speed
+            if t.received != t.last_bytes:
+                t.last_change = now
+            t.last_bytes = t.received
+
+    def stats(self, t):
+        eta = (t.size - t.received) / t.speed if t.speed else None
+        return dict(file=t.info.filename, bytes=t.received, size=t.size, speed=t.speed,
+                    eta=eta, retries=t.retries, stalls=t.stalls,
+                    idle=time() - t.last_change)
+
+    def report(self):
+        stats = [self.stats(t) for t in self.transfers]
+        total = dict(bytes=sum(st['bytes'] for st in stats),
+                     size=sum(st['size'] for st in stats),
+                     speed=sum(st['speed'] for st in stats),
+                     connections=self.connections)
+        if self.events:
+            for st in stats:
+                self.event('progress', **st)
+            self.event('total', **total)
+        if self.prom:
+            self.write_prom(stats, total)
+        if self.progress:
+            info = '\r'
+            for st in stats:
+                tmp = '[{}] {}%, {:.0f} MB, {:.2f} MB/s'.format(
+                    st['file'], st['bytes'] * 100 // max(st['size'], 1),
+                    st['bytes'] / 1024.0 / 1024.0, st['speed'] / 1024.0 / 1024.0)
+                info += tmp + ' ' * (35 - len(tmp))
+            print(info, end='', file=sys.stderr)
+            sys.stderr.flush()
+
+    def write_prom(self, stats, total):
+        metrics = [('bytes', 'Bytes downloaded so far'),
+                   ('size', 'Size of the file in bytes'),
+                   ('speed', 'Download speed in bytes per second'),
+                   ('eta', 'Estimated seconds until the file is finished'),
+                   ('retries', 'Requests retried'),
+                   ('stalls', 'Requests moved away from a stalled mirror'),
+                   ('idle', 'Seconds since the last byte was received')]
+        lines = []
+        for key, help in metrics:
+            name = 'wiki_download_{}'.format(key)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            for st in stats:
+                if st[key] is not None:
+                    lines.append('{}{{file="{}"}} {}'.format(name, st['file'], st[key]))
+        for key, value in sorted(total.items()):
+            name = 'wiki_download_total_{}'.format(key)
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+        lines.append('# TYPE wiki_download_last_update_seconds gauge')
+        lines.append('wiki_download_last_update_seconds {}'.format(time()))
+        with open(self.prom + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(self.prom + '.tmp', self.prom)
+
+    async def run(self):
+        if not (self.events or self.prom or self.progress):
             return
-        size_mb = count * block_size / 1024.0 / 1024.0
-        speed = (size_mb - self_log.last_mb) / (time() - self_log.last_time)
-        last_mb, last_time = size_mb, time()
-        percent = min(int(count * block_size * 100 / total_size), 100)
-        download_log[number] = Log(size_mb, size_mb, time() - self_log.st_time,
-            speed, percent, self_log.st_time, time())
-        info = '\r'
-        for n, log in download_log.items():
-            tmp = '[{}] {}%, {:.0f} MB, {:.2f} MB/s'.format(
-                n, log.percent, log.size_mb, log.speed)
-            info += tmp + ' ' * (35 - len(tmp))
-        print(info, end='')
-    return download_hook
+        while True:
+            await asyncio.sleep(telemetry_interval)
+            self.update(telemetry_interval)
+            self.report()
 
+    def close(self):
+        self.report()   # 最後的狀態
+        if self.events and self.events is not sys.stdout:
+            self.events.close()
 
-def download(info):
-    url, lang, date, size, output, filename, number = info
-    if not os.path.isdir(lang):
-        os.mkdir(lang)
 
-    st = dt.now()
-    download_log[number] = Log(0, 0, 0, 0, 0, time(), time())
-    urlretrieve(url, output, reporthook=gen_download_hook(number))
-    os.utime(output, (mktime(date.timetuple()),) * 2)
+# 每個檔案切成固定大小的 Range segment，由 Scheduler 分配給多條連線同時下載
+segment_size = 64 * 1024 * 1024
+min_split_size = 4 * 1024 * 1024   # 剩下的 segment 小於兩倍這個大小就不再切
+chunk_size = 1024 * 1024
+max_retries = 5
+
+# Scheduler 的設定
+initial_connections = 4
+per_host_connections = 8   # 同一個 host 最多同時幾條連線
+max_rate = None            # 總頻寬上限 (bytes/s)，None 表示不限速
+adjust_interval = 5.0      # 每隔幾秒依照下載速度調整一次連線數
+
+# 每個 Range request 的 timeout (秒)：連線、兩次收到資料之間、整個 request
+connect_timeout = 30
+read_timeout = 60
+transfer_timeout = None
+
+# mirror 的設定
+probe_size = 1024 * 1024   # 啟動時從每個 mirror 下載這麼多 bytes 來量速度並核對內容
+stall_timeout = 15         # 超過這麼多秒沒收到資料，就換一個 mirror
+slow_ratio = 0.2           # segment 的速度低於最快 mirror 的這個比例時，也換一個 mirror
+mirror_cooldown = 60       # 連續失敗的 mirror 暫停使用幾秒
+
+# .bz2 檔下載時順便建立 stream/block 索引 (見 bz2index.py)，
+# 解壓縮找 page id 的工作在另外 index_workers 個 thread 進行，不會影響下載
+index_bz2 = True
+index_workers = os.cpu_count() or 1
+
+# 驗證過的檔案放進 dumpcache (見 dumpcache.py)，<lang>/ 裡的是 hard link，
+# 刪掉之後重跑會直接從快取 link 回來，不必重新下載
+cache_enabled = True
+
+# 分析 manifest 等小檔案用的 (同步) session，下載本身用 aiohttp
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=per_host_connections))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=per_host_connections))
+
+
+def part_path(output):
+    """下載中的檔案旁會有一個 .part 檔，記錄已經完成的範圍。
+    只要 .part 檔還在，就表示檔案還沒下載完。
+    """
+    return output + '.part'
+
+
+def load_part(output, url, size):
+    """讀取 .part 檔，傳回已完成的範圍 [[start, end], ...]。
+    如果 server 上的檔案已經不同 (url 或大小改變)，就從頭開始。
+    """
+    try:
+        with open(part_path(output)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return []
+    if (state.get('url') != url or state.get('size') != size or
+            'ranges' not in state or not os.path.isfile(output)):
+        return []
+    return state['ranges']
+
+
+def save_part(output, url, size, ranges):
+    tmp = part_path(output) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'url': url, 'size': size, 'ranges': ranges}, f)
+    os.rename(tmp, part_path(output))
+
+
+def preallocate(output, size):
+    """先把目標檔案配置到完整大小，之後各 segment 直接寫到自己的位置。傳回 file descriptor。"""
+    fd = os.open(output, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass  # 有些檔案系統不支援，用 sparse file 也可以
+    return fd
+
+
+class StreamHasher(object):
+    """在下載過程中依序計算 md5/sha1。
+
+    各 segment 是同時下載的，只有剛好接在已計算位置之後的資料可以直接餵進 hash，
+    其他 segment 完成後，再從剛寫入的檔案 (還在 page cache 裡) 補讀，
+    所以不需要在下載完之後再把整個檔案讀一遍。補讀在另一個 thread 進行，不會卡住 event loop。
+    """
+
+    def __init__(self, consumers=()):
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.consumers = consumers   # 其他也需要依序看過所有內容的物件 (有 feed method)
+        self.pos = 0
+        self.busy = False
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha1.update(data)
+        for consumer in self.consumers:
+            consumer.feed(data)
+        self.pos += len(data)
+
+    def update_at(self, offset, data):
+        if offset == self.pos and not self.busy:
+            self.update(data)
+
+    def read_until(self, fd, end):
+        while self.pos < end:
+            self.update(os.pread(fd, min(chunk_size, end - self.pos), self.pos))
+
+    async def catch_up(self, fd, frontier):
+        """從檔案補讀到 frontier() 為止，frontier 會隨著 segment 完成而往後移"""
+        if self.busy:  # 已經有人在補讀，它會一路讀到最新的 frontier
+            return
+        self.busy = True
+        try:
+            loop = asyncio.get_event_loop()
+            while self.pos < frontier():
+                await loop.run_in_executor(None, self.read_until, fd, frontier())
+        finally:
+            self.busy = False
+
+    def digests(self):
+        return {'md5': self.md5.hexdigest(), 'sha1': self.sha1.hexdigest()}
+
+
+class Mirror(object):
+    """一個下載來源，記錄量到的延遲、速度 (EWMA) 及連續失敗次數"""
+
+    def __init__(self, base):
+        self.base = base
+        self.host = urlsplit(base).netloc
+        self.latency = None
+        self.speed = 0.0
+        self.failures = 0
+        self.disabled_until = 0
+        self.broken = False   # 內容和 dump_host 不同，這次不再使用
+
+    def url(self, url):
+        """dump_host 上的 url 在這個 mirror 上的網址"""
+        return self.base + url[len(dump_host):] if url.startswith(dump_host) else url
+
+    def healthy(self):
+        return not self.broken and time() >= self.disabled_until
+
+    def record(self, nbytes, seconds):
+        speed = nbytes / max(seconds, 1e-3)
+        self.speed = speed if not self.speed else 0.7 * self.speed + 0.3 * speed
+        self.failures = 0
+
+    def fail(self):
+        self.failures += 1
+        if self.failures >= 3:
+            self.disabled_until = time() + mirror_cooldown
+
+    def __repr__(self):
+        return '<Mirror {} {:.2f} MB/s>'.format(self.host, self.speed / 1024.0 / 1024.0)
+
+
+class MirrorStalled(IOError):
+    pass
+
+
+class Segment(object):
+    """檔案中 [start, end] 的一段，pos 是下一個要寫入的位置。
+    end 可能在下載中途被 split() 縮短，把後半段交給另一條連線。
+    mirror 是目前負責下載這一段的來源。
+    """
+
+    def __init__(self, transfer, start, end):
+        self.transfer = transfer
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.st_time = time()
+        self.mirror = None
+        self.req_time = self.st_time
+        self.req_pos = start
+        self.slow = False
+
+    @property
+    def host(self):
+        return self.mirror.host if self.mirror else urlsplit(self.transfer.url).netloc
+
+    def remaining(self):
+        return self.end + 1 - self.pos
+
+    def speed(self):
+        return (self.pos - self.start) / max(time() - self.st_time, 1e-3)
+
+    def req_speed(self):
+        """目前這個 request 的速度"""
+        return (self.pos - self.req_pos) / max(time() - self.req_time, 1e-3)
+
+    def split(self):
+        if self.remaining() < 2 * min_split_size:
+            return None
+        mid = self.pos + self.remaining() // 2
+        tail = Segment(self.transfer, mid, self.end)
+        self.end = mid - 1
+        return tail
+
+
+class Transfer(object):
+    """一個檔案的下載狀態：預先配置好的檔案、已完成的範圍 (.part)、hash 及 bz2 索引。
+    index_pool 是解壓縮 block 找 page id 用的 executor，None 表示不建索引。
+    """
+
+    def __init__(self, info, index_pool=None):
+        self.info = info
+        self.url, self.size, self.output = info.url, info.size, info.path
+        if not os.path.isdir(os.path.dirname(self.output)):
+            os.makedirs(os.path.dirname(self.output))
+        self.ranges = load_part(self.output, self.url, self.size)
+        self.fd = preallocate(self.output, self.size)
+        save_part(self.output, self.url, self.size, self.ranges)
+        self.scanner = bz2index.Scanner() if index_pool and self.output.endswith('.bz2') else None
+        self.index_pool = index_pool
+        self.indexing = set()
+        self.hasher = StreamHasher([self.scanner] if self.scanner else ())
+        self.received = sum(end + 1 - start for start, end in self.ranges)
+        self.retries = 0
+        self.stalls = 0
+        self.st_time = dt.now()
+
+        # 還沒完成的部分，切成 segment_size 大小的 segment
+        self.pending = []
+        pos = 0
+        for start, end in sorted(self.ranges) + [(self.size, self.size)]:
+            for seg_start in range(pos, start, segment_size):
+                self.pending.append(Segment(self, seg_start, min(seg_start + segment_size, start) - 1))
+            pos = max(pos, end + 1)
+
+    def unassigned(self):
+        return sum(seg.remaining() for seg in self.pending)
+
+    def frontier(self):
+        """從頭開始連續完成的範圍的結尾"""
+        pos = 0
+        for start, end in sorted(self.ranges):
+            if start > pos:
+                break
+            pos = max(pos, end + 1)
+        return pos
+
+    def finished(self):
+        return self.frontier() >= self.size
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+        self.hasher.update_at(offset, data)
+        self.received += len(data)
+        self.index_blocks()
+
+    def index_blocks(self):
+        """結尾已經確定的 block 交給 index_pool 解壓縮，找出其中的 page id"""
+        if not self.scanner:
+            return
+        loop = asyncio.get_event_loop()
+        for start, end in self.scanner.pop_ready():
+            future = loop.run_in_executor(self.index_pool, self.scanner.find_pages,
+                                          self.output, start, end)
+            self.indexing.add(future)
+            future.add_done_callback(self.indexing.discard)
+
+    async def complete(self, seg):
+        await asyncio.get_event_loop().run_in_executor(None, os.fsync, self.fd)
+        self.ranges.append([seg.start, seg.end])
+        save_part(self.output, self.url, self.size, self.ranges)
+        await self.hasher.catch_up(self.fd, self.frontier)
+        self.index_blocks()
+
+    async def close(self):
+        await self.hasher.catch_up(self.fd, self.frontier)
+        self.index_blocks()
+        if self.indexing:
+            await asyncio.wait(self.indexing)
+        self.abort()
+        return self.hasher.digests()
+
+    def save_index(self):
+        """hash 核對過後才寫索引，有索引就表示它和檔案內容一致"""
+        if self.scanner:
+            bz2index.save_index(self.output, self.scanner.index())
+
+    def abort(self):
+        """關閉檔案，.part 檔留著，下次可以續傳"""
+        for future in list(self.indexing):
+            future.cancel()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Throttle(object):
+    """token bucket，讓所有連線加起來不超過 rate (bytes/s)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time()
+
+    async def consume(self, n):
+        if not self.rate:
+            return
+        now = time()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= n
+        if self.allowance < 0:
+            await asyncio.sleep(-self.allowance / self.rate)
+
+
+class Scheduler(object):
+    """分配 segment 給連線，並依照實際的下載速度調整同時使用的連線數。
+
+    每隔 adjust_interval 秒量一次總速度：多開一條連線後速度有明顯提升就繼續加，
+    沒有提升就退回去並維持一段時間，接近 max_rate 時不再增加。
+    同一個 host 不會超過 per_host_connections 條連線。
+    剩下的工作先分給未分配量最多的檔案；沒有新的 segment 時，把預估最晚完成的
+    segment 切一半給空出來的連線，避免最後只剩一個大檔案用一條連線慢慢下載。
+    """
+
+    def __init__(self, rate=None, per_host=None, connections=None, http=None, sources=None,
+                 telemetry=None):
+        self.max_rate = rate or max_rate
+        self.per_host = per_host or per_host_connections
+        self.limit = connections or initial_connections
+        self.http = http   # aiohttp.ClientSession，None 的話 run() 會自己建立
+        self.mirrors = [Mirror(base) for base in (sources or [dump_host] + mirrors)]
+        self.throttle = Throttle(self.max_rate)
+        self.telemetry = telemetry or Telemetry()
+        self.active = set()
+        self.tasks = set()
+        self.received = 0
+        self.last_rate = None
+        self.probing = False
+        self.hold = 0
+        self.error = None
+        self.wakeup = None
+
+    def host_count(self, host):
+        return sum(1 for seg in self.active if seg.host == host)
+
+    def pick_mirror(self, exclude=None):
+        """還有空位的 mirror 中最快的一個；沒有其他選擇時才用 exclude"""
+        mirrors = [m for m in self.mirrors if m.healthy() and
+                   self.host_count(m.host) < self.per_host]
+        others = [m for m in mirrors if m is not exclude]
+        if others or mirrors:
+            return max(others or mirrors, key=lambda m: m.speed)
+        return None
+
+    def next_segment(self, transfers):
+        mirror = self.pick_mirror()
+        if mirror is None:
+            return None
+        candidates = [t for t in transfers if t.pending]
+        if candidates:
+            seg = max(candidates, key=Transfer.unassigned).pending.pop(0)
+        else:
+            # 沒有新的 segment 了，把預估最晚完成的 segment 切一半
+            if not self.active:
+                return None
+            slowest = max(self.active, key=lambda seg: seg.remaining() / max(seg.speed(), 1.0))
+            seg = slowest.split()
+        if seg is not None:
+            seg.mirror = mirror
+        return seg
+
+    def adjust(self, rate):
+        """hill climbing：比較這次和上次的總速度，決定要加或減一條連線"""
+        capacity = self.per_host * max(sum(1 for m in self.mirrors if m.healthy()), 1)
+        if self.max_rate and rate > self.max_rate * 0.9:
+            # 已經接近頻寬上限，再多開連線也沒有用
+            if rate > self.max_rate * 1.1:
+                self.limit = max(1, self.limit - 1)
+            self.probing = False
+        elif self.probing and self.last_rate and rate < self.last_rate * 1.05:
+            # 多開的連線沒有幫助，退回去並等一陣子再試
+            self.limit = max(1, self.limit - 1)
+            self.probing = False
+            self.hold = 6
+        elif self.hold > 0:
+            self.hold -= 1
+        elif self.limit < capacity and len(self.active) >= self.limit:
+            self.limit += 1
+            self.probing = True
+        self.last_rate = rate
+
+    async def control(self):
+        while True:
+            received = self.received
+            await asyncio.sleep(adjust_interval)
+            self.adjust((self.received - received) / adjust_interval)
+            self.watch()
+            self.wakeup.set()
+
+    def watch(self):
+        """找出明顯比其他 mirror 慢的 segment，讓它換一個 mirror"""
+        healthy = [m for m in self.mirrors if m.healthy()]
+        if len(healthy) < 2:
+            return
+        best = max(m.speed for m in healthy)
+        for seg in self.active:
+            if (time() - seg.req_time > adjust_interval and
+                    seg.req_speed() < best * slow_ratio and seg.mirror.speed < best):
+                seg.slow = True
+
+    async def probe(self, transfer):
+        """從每個 mirror 下載 transfer 開頭的 probe_size bytes，量延遲及速度。
+        檔案大小或內容和 dump_host 不同的 mirror 這次不使用。
+        """
+        end = min(probe_size, transfer.size) - 1
+
+        async def probe_one(mirror):
+            st = time()
+            try:
+                async with self.http.get(mirror.url(transfer.url),
+                                         headers={'Range': 'bytes=0-{}'.format(end)}) as r:
+                    mirror.latency = time() - st
+                    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+                    if r.status != 206 or total != str(transfer.size):
+                        mirror.broken = True
+                        return None
+                    data = await asyncio.wait_for(r.read(), stall_timeout)
+                mirror.record(len(data), time() - st)
+                return hashlib.sha1(data).hexdigest()
+            except (IOError, aiohttp.ClientError, asyncio.TimeoutError):
+                mirror.disabled_until = time() + mirror_cooldown
+                return None
+
+        digests = await asyncio.gather(*[probe_one(m) for m in self.mirrors])
+        # 以 dump_host 為準，dump_host 失敗時以多數為準
+        known = [d for d in digests if d]
+        if not known:
+            return
+        reference = digests[0] or max(set(known), key=known.count)
+        for mirror, digest in zip(self.mirrors, digests):
+            if digest and digest != reference:
+                mirror.broken = True
+        print('mirrors: {}'.format(sorted((m for m in self.mirrors if m.healthy()),
+                                          key=lambda m: -m.speed)), file=sys.stderr)
+
+    async def request(self, seg):
+        url = seg.mirror.url(seg.transfer.url)
+        headers = {'Range': 'bytes={}-{}'.format(seg.pos, seg.end)}
+        seg.req_time, seg.req_pos, seg.slow = time(), seg.pos, False
+        async with self.http.get(url, headers=headers) as r:
+            if r.status != 206:
+                raise IOError('{} does not support range requests (HTTP {})'.format(url, r.status))
+            while seg.remaining() > 0:
+                try:
+                    data = await asyncio.wait_for(r.content.read(chunk_size), stall_timeout)
+                except asyncio.TimeoutError:
+                    raise MirrorStalled('no data from {} for {}s'.format(seg.mirror.host, stall_timeout))
+                if not data:
+                    break
+                data = data[:seg.remaining()]  # 可能已經被 split() 縮短
+                seg.transfer.write(seg.pos, data)
+                seg.pos += len(data)
+                self.received += len(data)
+                if seg.slow:
+                    raise MirrorStalled('{} is too slow ({:.2f} MB/s)'.format(
+                        seg.mirror.host, seg.req_speed() / 1024.0 / 1024.0))
+                await self.throttle.consume(len(data))
+        seg.mirror.record(seg.pos - seg.req_pos, time() - seg.req_time)
+        if seg.remaining() > 0:
+            raise IOError('segment {}-{} ended at {}'.format(seg.start, seg.end, seg.pos))
+
+    async def fetch(self, seg):
+        """下載 seg 並寫入檔案。連線中斷或逾時時，從 seg 已寫入的位置繼續；
+        有其他 mirror 可用時，改從其中最快的一個繼續。
+        """
+        for retry in range(max_retries + 1):
+            try:
+                await asyncio.wait_for(self.request(seg), transfer_timeout)
+                return
+            except (IOError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if retry == max_retries:
+                    raise
+                self.telemetry.retry(seg.transfer, seg.mirror.url(seg.transfer.url), e,
+                                     isinstance(e, MirrorStalled))
+                seg.mirror.fail()
+                mirror = self.pick_mirror(exclude=seg.mirror)
+                if mirror is None or mirror is seg.mirror:
+                    await asyncio.sleep(2 ** retry)
+                else:
+                    seg.mirror = mirror
+
+    async def work(self, seg, on_finish):
+        try:
+            await self.fetch(seg)
+            await seg.transfer.complete(seg)
+            if seg.transfer.finished():
+                await on_finish(seg.transfer)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self.active.discard(seg)
+            self.telemetry.connections = len(self.active)
+            self.wakeup.set()
+
+    async def run(self, transfers, on_finish):
+        """下載所有 transfers，每個檔案完成時 await on_finish(transfer)"""
+        self.wakeup = asyncio.Event()
+        own_http = self.http is None
+        if own_http:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.per_host),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                              sock_read=read_timeout))
+        for t in transfers:
+            if t.finished():  # 只差驗證 (例如上次驗證前就中斷了)
+                await on_finish(t)
+        transfers = [t for t in transfers if not t.finished()]
+        if len(self.mirrors) > 1 and transfers:
+            await self.probe(transfers[0])
+        for t in transfers:
+            self.telemetry.start(t)
+        controller = asyncio.ensure_future(self.control())
+        reporter = asyncio.ensure_future(self.telemetry.run())
+        try:
+            while not self.error:
+                while len(self.active) < self.limit:
+                    seg = self.next_segment(transfers)
+                    if seg is None:
+                        break
+                    self.active.add(seg)
+                    self.telemetry.connections = len(self.active)
+                    task = asyncio.ensure_future(self.work(seg, on_finish))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                if not self.active and not any(t.pending for t in transfers):
+                    break
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        finally:
+            controller.cancel()
+            reporter.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(controller, reporter, *self.tasks, return_exceptions=True)
+            if own_http:
+                await self.http.close()
+        if self.error:
+            raise self.error
+
+
+def hash_file(path):
+    """計算既有檔案的 md5/sha1 (只有 ledger 沒有記錄時才需要)"""
+    hasher = StreamHasher()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(data)
+    return hasher.digests()
+
+
+def verify(info, digests):
+    """核對 hash，通過後設定檔案日期並記錄到 ledger，傳回 ledger 的記錄"""
+    url, lang, date, size, output, filename, number, md5, sha1 = info
     assert os.stat(output).st_size == size, '{} downloaded failed'.format(filename)
-    ed = dt.now()
-    del download_log[number]
-    duration = (ed - st).total_seconds()
-    print("\n[{}] finished, average speed = {:.2f} MB/s".format(
-        filename, size / 1024.0 / 1024.0 / duration))
+    for algo, expected in (('md5', md5), ('sha1', sha1)):
+        if expected and digests[algo] != expected:
+            for fn in (output, part_path(output)):
+                if os.path.isfile(fn):
+                    os.remove(fn)
+            record_ledger(lang, filename, None)
+            raise IOError('{} {} mismatch: got {}, expected {}'.format(
+                filename, algo, digests[algo], expected))
+    os.utime(output, (mktime(date.timetuple()),) * 2)
+    if os.path.isfile(part_path(output)):
+        os.remove(part_path(output))
+    digests.update(size=size, mtime=os.stat(output).st_mtime)
+    record_ledger(lang, filename, digests)
+    return digests
+
 
+def from_cache(info):
+    """dumpcache 裡已經有這個檔案的話，link 到 info.path 並記錄到 ledger，傳回 True"""
+    if not cache_enabled:
+        return False
+    entry = dumpcache.DumpCache().fetch(info.path, info.lang, info.filename, info.size,
+                                        info.md5, info.sha1)
+    if not entry:
+        return False
+    if os.path.isfile(part_path(info.path)):
+        os.remove(part_path(info.path))
+    record_ledger(info.lang, info.filename, {'md5': entry['md5'], 'sha1': entry['sha1'],
+                                             'size': entry['size'], 'mtime': entry['mtime']})
+    return True
 
-def dump_wiki(lang):
-    infos = prepare_wiki_url(lang)
-    print(infos)
-    print(len(infos))
-    pool = Pool(3)
-    pool.map(download, infos)
+
+def to_cache(info, digests):
+    """把驗證過的檔案放進 dumpcache，info.path 換成指向快取的 hard link"""
+    if cache_enabled:
+        dumpcache.DumpCache().store(info.path, info.lang, info.filename, digests,
+                                    info.date.strftime('%Y%m%d'))
+
+
+# ----------------------------------------------------------------------
+# 非同步 API：可以在呼叫者自己的 event loop 裡下載，不會影響 process 的其他部分。
+# 取消 (Task.cancel) 時會關閉連線及檔案，.part 檔會留著，下次可以續傳。
+
+async def plan_async(lang, date=None, multistream=False):
+    """prepare_wiki_url 的 coroutine 版本"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, prepare_wiki_url, lang, date, multistream)
+
+
+async def download_async(infos, rate=None, http=None, telemetry=None):
+    """下載 infos (prepare_wiki_url 傳回的 Download) 中所有的檔案，由同一個 Scheduler 分配連線。
+    rate 是總頻寬上限 (bytes/s)，預設使用 max_rate；
+    http 是要共用的 aiohttp.ClientSession，None 的話會自己建立一個；
+    telemetry 是 Telemetry，None 的話依照 events_path/prom_path/show_progress 建立。
+    """
+    loop = asyncio.get_event_loop()
+    telemetry = telemetry or Telemetry()
+    transfers = []
+    index_pool = ThreadPoolExecutor(index_workers) if index_bz2 else None
+
+    async def finish(t):
+        digests = verify(t.info, await t.close())
+        t.save_index()
+        to_cache(t.info, digests)
+        telemetry.finish(t)
+
+    try:
+        for info in infos:
+            if from_cache(info):
+                telemetry.event('cached', file=info.filename, size=info.size)
+            elif (os.path.isfile(info.path) and not os.path.isfile(part_path(info.path)) and
+                    os.stat(info.path).st_size == info.size):
+                # 檔案完整但 ledger 沒有記錄 (例如舊版下載的)，算一次 hash 就好，不必重新下載
+                to_cache(info, verify(info, await loop.run_in_executor(None, hash_file, info.path)))
+                telemetry.event('verified', file=info.filename, size=info.size)
+            else:
+                transfers.append(Transfer(info, index_pool))
+        await Scheduler(rate, http=http, telemetry=telemetry).run(transfers, finish)
+    finally:
+        for t in transfers:
+            t.abort()
+        if index_pool:
+            index_pool.shutdown(wait=False)
+        telemetry.close()
+
+
+async def dump_wiki_async(lang, date=None, multistream=False, rate=None, http=None):
+    infos = await plan_async(lang, date, multistream)
+    print(infos, file=sys.stderr)
+    print(len(infos), file=sys.stderr)
+    await download_async(infos, rate, http)
+
+
+def run(coro):
+    """在新的 event loop 裡執行 coro，給命令列及同步的呼叫者用"""
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # 讓 coro 的 finally 執行完 (例如結束子 process) 再離開
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except (asyncio.CancelledError, Exception):
+            pass
+        raise
+    finally:
+        loop.close()
+
+
+def download_all(infos, rate=None):
+    run(download_async(infos, rate))
+
+
+def download(info):
+    download_all([info])
+
+
+def dump_incr(lang, date=None):
+    """下載每日的 adds-changes dump，傳回檔案路徑"""
+    info = prepare_incr_url(lang, date)
+    download(info)
+    return info.path
+
+
+def dump_wiki(lang, date=None, multistream=False, rate=None):
+    run(dump_wiki_async(lang, date, multistream, rate))
 
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) == 1:
-        for lang in ('en', 'zh', 'ja'):
-            dump_wiki(lang)
-    else:
-        dump_wiki(sys.argv[1])
+    import argparse
+    parser = argparse.ArgumentParser(description='Download Wikipedia pages-articles dumps.')
+    parser.add_argument('langs', nargs='*', default=['en', 'zh', 'ja'],
+                        help='languages to download (default: en zh ja)')
+    parser.add_argument('--date', help='dump date (YYYYMMDD), default: the latest')
+    parser.add_argument('--urls', action='store_true',
+                        help='only print the URLs to download (used by scripts/stream.sh)')
+    parser.add_argument('--incr', action='store_true',
+                        help='download the daily adds-changes dump and print its path last '
+                        '(used by scripts/update.sh)')
+    parser.add_argument('--rate', type=float, help='bandwidth cap in bytes/s')
+    parser.add_argument('--mirror', action='append', default=[],
+                        help='additional mirror with the same layout as {}'.format(dump_host))
+    parser.add_argument('--events', help="write newline-delimited JSON events to this file ('-' for stdout)")
+    parser.add_argument('--prom-file', help='keep rewriting a Prometheus textfile with transfer metrics')
+    parser.add_argument('--cache-dir', default=dumpcache.cache_dir,
+                        help='shared cache of verified dumps (default: %(default)s)')
+    parser.add_argument('--cache-size', type=float,
+                        help='evict least recently used dumps above this many GB')
+    parser.add_argument('--keep', type=int, default=dumpcache.default_retention,
+                        help='number of dumps to keep per language (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the cache')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a progress line on stderr (default when stderr is a terminal)')
+    parser.add_argument('--no-progress', dest='progress', action='store_false',
+                        help='do not show the progress line')
+    parser.set_defaults(progress=show_progress)
+    args = parser.parse_args()
+
+    mirrors += args.mirror
+    events_path, prom_path, show_progress = args.events, args.prom_file, args.progress
+    cache_enabled = not args.no_cache
+    dumpcache.cache_dir, dumpcache.default_retention = args.cache_dir, args.keep
+    if args.cache_size:
+        dumpcache.cache_size = int(args.cache_size * 1024 ** 3)
+    for lang in args.langs:
+        if args.urls:
+            # 只列出要下載的網址，給 scripts/stream.sh 邊下載邊解析用
+            for info in prepare_wiki_url(lang, args.date):
+                print(info.url)
+        elif args.incr:
+            # 下載每日更新，最後一行印出檔案路徑，給 scripts/update.sh 用
+            print('\n' + dump_incr(lang, args.date))
+        else:
+            dump_wiki(lang, args.date, rate=args.rate)
@@ -52,26 +52,44 @@ import argparse
 import bz2
 import codecs
 import cgi
-import fileinput
+import glob
+import gzip
+import heapq
+import io
+import itertools
 import logging
+import mmap
 import os.path
 import re  # TODO use regex when it will be standard
+import shutil
+import sqlite3
+import struct
+import subprocess
+import tempfile
+import threading
 import time
 import urllib
+import zlib
 try:
+    import cPickle as pickle
     from cStringIO import StringIO
     from htmlentitydefs import name2codepoint
     from itertools import izip, izip_longest
+    import Queue as queue
 except ImportError:
+    import pickle
     from io import StringIO
     from html.entities import name2codepoint
+    import queue
     izip = zip
     from itertools import zip_longest as izip_longest
 
-from multiprocessing import Queue, Process, Value, cpu_count
+from collections import deque, namedtuple
+from multiprocessing import Pool, Queue, Process, Value, cpu_count
 from timeit import default_timer
+from xml.sax.saxutils import escape
 from segment import segment_text
-import traceback
+import bz2index
 
 # ===========================================================================
 
@@ -497,21 +515,23 @@ class Extractor(object):
     expand_templates = True
 
 
-    def __init__(self, id, title, lines):
+    def __init__(self, id, title, text):
         """
         :param id: id of page.
         :param title: tutle of page.
-        :param lines: a list of lines.
+        :param text: wikitext of the page (str, or UTF-8 encoded bytes).
         """
         global lang
         self.id = id
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
         if lang == 'zh':
             from zhconvert import conv2tw
             self.title = conv2tw(title)
-            self.text = conv2tw(''.join(lines))
+            self.text = conv2tw(text)
         else:
             self.title = title
-            self.text = ''.join(lines)
+            self.text = text
         text = self.text
         title = self.title
 
@@ -909,6 +929,8 @@ class Extractor(object):
             return ''
 
         redirected = redirects.get(title)
+        if not redirected and templateStore:
+            redirected = templateStore.redirect(title)
         if redirected:
             title = redirected
 
@@ -920,6 +942,14 @@ class Extractor(object):
             # add it to cache
             templateCache[title] = template
             del templates[title]
+        elif templateStore:
+            template = templateStore.template(title)
+            if template is None:
+                return ''
+            # templates can be read again from the store: keep the cache small
+            if len(templateCache) >= templateStore.cache_size:
+                templateCache.clear()
+            templateCache[title] = template
         else:
             # The page being included could not be identified
             return ''
@@ -1698,25 +1728,30 @@ redirects = {}
 # cache of parser templates
 # FIXME: sharing this with a Manager slows down.
 templateCache = {}
+# TemplateStore to look up templates not in templates/redirects
+templateStore = None
 
 
 def define_template(title, page):
     """
     Adds a template defined in the :param page:.
-    @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
     """
-    global templates
-    global redirects
+    redirect, text = template_definition(page)
+    add_template(title, redirect, text)
 
-    # title = normalizeTitle(title)
 
+def template_definition(page):
+    """
+    Prepare the template defined in :param page: for inclusion.
+    @see https://en.wikipedia.org/wiki/Help:Template#Noinclude.2C_includeonly.2C_and_onlyinclude
+    :return: (redirect target or None, template text)
+    """
     # check for redirects
-    m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', page[0], re.IGNORECASE)
+    m = re.match('#REDIRECT.*?\[\[([^\]]*)]]', page, re.IGNORECASE)
     if m:
-        redirects[title] = m.group(1)  # normalizeTitle(m.group(1))
-        return
+        return m.group(1), None  # normalizeTitle(m.group(1))
 
-    text = unescape(''.join(page))
+    text = unescape(page)
 
     # We're storing template text for future inclusion, therefore,
     # remove all <noinclude> text and keep all <includeonly> text
@@ -1743,13 +1778,115 @@ def define_template(title, page):
         text = onlyincludeAccumulator
     else:
         text = reIncludeonly.sub('', text)
+    return None, text
+
+
+def add_template(title, redirect, text):
+    """
+    Adds a template or redirect, as returned by template_definition().
+    """
+    global templates
+    global redirects
+
+    # title = normalizeTitle(title)
 
-    if text:
+    if redirect:
+        redirects[title] = redirect
+    elif text:
         if title in templates:
             logging.warn('Redefining: %s', title)
         templates[title] = text
 
 
+# ----------------------------------------------------------------------
+# Template store
+
+def template_to_json(template):
+    """
+    :return: :param template: as nested lists: TemplateText as strings,
+    TemplateArg as [name, default].
+    """
+    return [[template_to_json(part.name),
+             None if part.default is None else template_to_json(part.default)]
+            if isinstance(part, TemplateArg) else str(part)
+            for part in template]
+
+
+def template_from_json(data):
+    """Rebuild a Template saved by template_to_json() without parsing it again."""
+    template = Template()
+    for part in data:
+        if isinstance(part, list):
+            arg = TemplateArg.__new__(TemplateArg)
+            arg.name = template_from_json(part[0])
+            arg.default = None if part[1] is None else template_from_json(part[1])
+            template.append(arg)
+        else:
+            template.append(TemplateText(part))
+    return template
+
+
+class TemplateStore(object):
+    """
+    Templates and redirects saved in an SQLite database, with the templates
+    already parsed.
+    Each process opens it read-only and looks templates up when they are
+    used, so that the workers share the data through the OS page cache
+    instead of each holding its own copy.
+    """
+
+    # max number of parsed templates kept by each process
+    cache_size = 20000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.pid = None
+
+    def connection(self):
+        # a connection cannot be shared with forked processes
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+            self.db.execute('PRAGMA mmap_size = %d' % (1 << 30))
+            self.pid = os.getpid()
+        return self.db
+
+    def template(self, title):
+        """:return: the parsed Template, or None."""
+        row = self.connection().execute('SELECT parsed FROM templates WHERE title = ?',
+                                        (title,)).fetchone()
+        return template_from_json(json.loads(row[0])) if row else None
+
+    def redirect(self, title):
+        row = self.connection().execute('SELECT target FROM redirects WHERE title = ?',
+                                        (title,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM templates').fetchone()[0]
+
+
+def save_template_store(path):
+    """
+    Parse the loaded templates and save them with the redirects to a new
+    template store at :param path:.
+    """
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.execute('CREATE TABLE templates (title TEXT PRIMARY KEY, text TEXT, parsed TEXT)')
+    db.execute('CREATE TABLE redirects (title TEXT PRIMARY KEY, target TEXT)')
+    db.executemany('INSERT INTO templates VALUES (?, ?, ?)',
+                   ((title, text, json.dumps(template_to_json(Template.parse(text))))
+                    for title, text in templates.items()))
+    db.executemany('INSERT INTO redirects VALUES (?, ?)', redirects.items())
+    db.commit()
+    db.close()
+    os.rename(tmp, path)
+    logging.info("Saved %d templates to '%s'", len(templates), path)
+
+
 # ----------------------------------------------------------------------
 
 def dropNested(text, openDelim, closeDelim):
@@ -2437,6 +2574,150 @@ class OutputSplitter(object):
             return open(filename, 'w')
 
 
+docIdRE = re.compile(br'"id": "(\d+)"')
+
+# map of the documents of a corpus to their files, in the corpus directory
+corpus_map_name = '.docids'
+
+
+def open_docs(filename, mode='r'):
+    """Open an output file written by OutputSplitter."""
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, mode + 'b')
+    return open(filename, mode + 'b')
+
+
+def doc_ids(filename):
+    """
+    :return: the page ids of the documents in output file :param filename:.
+    """
+    ids = []
+    with open_docs(filename) as f:
+        for line in f:
+            # the title precedes the id in each document, and any quote
+            # in it is escaped, so the first match is the page id
+            m = docIdRE.search(line)
+            if m:
+                ids.append(m.group(1).decode('ascii'))
+    return ids
+
+
+def corpus_files(corpus_dir, skip=None):
+    """
+    :return: the paths, relative to :param corpus_dir:, of its output files,
+    except those in directory :param skip:.
+    """
+    for dirpath, dirnames, filenames in os.walk(corpus_dir):
+        if skip and os.path.abspath(dirpath) == skip:
+            del dirnames[:]
+            continue
+        for filename in filenames:
+            if not filename.startswith('.') and not filename.endswith('.tmp'):
+                yield os.path.relpath(os.path.join(dirpath, filename), corpus_dir)
+
+
+def update_corpus_map(conn, corpus_dir, skip=None):
+    """
+    Bring the map of the documents of :param corpus_dir: to their files up to
+    date, reading only the files added or changed since its last update.
+    """
+    known = dict(conn.execute('SELECT path, mtime FROM files'))
+    for path in corpus_files(corpus_dir, skip):
+        filename = os.path.join(corpus_dir, path)
+        mtime = os.path.getmtime(filename)
+        if known.pop(path, None) != mtime:
+            conn.execute('DELETE FROM docs WHERE path = ?', (path,))
+            conn.executemany('INSERT INTO docs VALUES (?, ?)',
+                             ((id, path) for id in doc_ids(filename)))
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (path, mtime))
+    for path in known:
+        # removed, or skipped this time
+        conn.execute('DELETE FROM docs WHERE path = ?', (path,))
+        conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+
+def dump_page_ids(input_file):
+    """
+    :return: the ids of all the pages of :param input_file:, redirects and
+    pages whose text was deleted included.
+    """
+    ids = set()
+    input = open_input(input_file)
+    buf = b''
+    while True:
+        chunk = input.read(scan_chunk_size)
+        data = buf + chunk
+        headers, cut = page_headers(data)
+        ids.update(str(id) for _, id, _, _ in headers)
+        if not chunk:
+            break
+        # a <page> tag or a header may continue in the next chunk
+        buf = data[cut:] if cut is not None else data[-len('<page>') + 1:]
+    input.close()
+    return ids
+
+
+def merge_corpus(update_dir, corpus_dir, input_files=()):
+    """
+    Merge the documents extracted into :param update_dir: into the corpus
+    in :param corpus_dir:, by removing from the corpus files the older
+    documents with the same page ids. The documents of the other pages of the
+    incremental dumps :param input_files:, which have become redirects or
+    whose text was deleted, are removed as well.
+    :param update_dir: itself is left untouched, it is usually a
+    subdirectory of :param corpus_dir:.
+    Only the files holding such documents are rewritten: they are found with
+    a map of the documents to their files, kept in :param corpus_dir:.
+    """
+    update_dir = os.path.abspath(update_dir)
+    ids = set()
+    for path in corpus_files(update_dir):
+        ids.update(doc_ids(os.path.join(update_dir, path)))
+    for input_file in input_files:
+        if input_file == '-' or not os.path.isfile(input_file):
+            logging.warning("Can't read '%s' again: its redirects and deleted pages are kept in %s",
+                            input_file, corpus_dir)
+            continue
+        ids.update(dump_page_ids(input_file))
+    logging.info("Merging %d updated pages into %s", len(ids), corpus_dir)
+
+    conn = sqlite3.connect(os.path.join(corpus_dir, corpus_map_name))
+    conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS docs (id TEXT, path TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS docs_id ON docs (id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS docs_path ON docs (path)')
+    with conn:
+        update_corpus_map(conn, corpus_dir, update_dir)
+    conn.execute('CREATE TEMP TABLE updated (id TEXT PRIMARY KEY)')
+    conn.executemany('INSERT INTO updated VALUES (?)', ((id,) for id in ids))
+    paths = [path for path, in conn.execute(
+        'SELECT DISTINCT path FROM docs WHERE id IN (SELECT id FROM updated)')]
+
+    replaced = 0
+    for path in paths:
+        filename = os.path.join(corpus_dir, path)
+        kept = []
+        with open_docs(filename) as f:
+            for line in f:
+                m = docIdRE.search(line)
+                if m and m.group(1).decode('ascii') in ids:
+                    replaced += 1
+                else:
+                    kept.append(line)
+        with open_docs(filename + '.tmp', 'w') as f:
+            f.writelines(kept)
+        os.rename(filename + '.tmp', filename)
+        with conn:
+            conn.execute('DELETE FROM docs WHERE path = ? AND id IN (SELECT id FROM updated)', (path,))
+            conn.execute('UPDATE files SET mtime = ? WHERE path = ?',
+                         (os.path.getmtime(filename), path))
+    # the documents of update_dir are now part of the corpus
+    with conn:
+        update_corpus_map(conn, corpus_dir)
+    conn.close()
+    logging.info("Replaced %d documents in %d files", replaced, len(paths))
+
+
 # ----------------------------------------------------------------------
 # READER
 
@@ -2444,18 +2725,237 @@ tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
 #                    1     2               3      4
 
 
-def load_templates(file, output_file=None):
+class HTTPInput(io.RawIOBase):
+    """
+    Read-only stream over an http(s) URL, so that a dump can be extracted
+    while it is being downloaded, without landing it on disk.
+    A background thread reads ahead into a bounded queue, overlapping network
+    time with decompression and parsing; if the connection drops, it resumes
+    with a Range request from the last byte received.
+    """
+
+    chunk_size = 1024 * 1024
+    read_ahead = 64             # chunks buffered ahead of the reader
+    max_retries = 5
+
+    def __init__(self, url):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+        self.chunks = queue.Queue(maxsize=self.read_ahead)
+        self.buffer = b''
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._fetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fetch(self):
+        pos = 0
+        size = None
+        retry = 0
+        while not self.stopped:
+            try:
+                headers = {'Range': 'bytes=%d-' % pos} if pos else {}
+                r = self.session.get(self.url, stream=True, timeout=60, headers=headers)
+                if 400 <= r.status_code < 500:
+                    # a missing or forbidden dump: retrying won't help
+                    r.close()
+                    self.chunks.put(IOError('%s: HTTP %d %s' % (self.url, r.status_code, r.reason)))
+                    return
+                r.raise_for_status()
+                if pos and r.status_code != 206:
+                    raise IOError('%s does not support resuming' % self.url)
+                if size is None:
+                    size = int(r.headers.get('Content-Length', -1))
+                for data in r.iter_content(self.chunk_size):
+                    if self.stopped:
+                        break
+                    self.chunks.put(data)
+                    pos += len(data)
+                    retry = 0
+                r.close()
+                if size < 0 or pos >= size or self.stopped:
+                    break
+                raise IOError('connection closed at %d of %d bytes' % (pos, size))
+            except Exception as e:
+                if retry == self.max_retries:
+                    self.chunks.put(e)
+                    return
+                retry += 1
+                logging.warn('Reading %s: %s; resuming from byte %d', self.url, e, pos)
+                time.sleep(2 ** retry)
+        self.chunks.put(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.eof:
+            data = self.chunks.get()
+            if isinstance(data, Exception):
+                raise data
+            self.buffer = data
+            self.eof = not data
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.stopped = True
+        # unblock the fetcher if it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                self.thread.join(0.1)
+        super(HTTPInput, self).close()
+
+
+# ----------------------------------------------------------------------
+# Input codecs
+
+class PipeInput(object):
+    """
+    Read the output of a decompression command like a file.
+    Running the decoder in its own process (possibly multi-threaded) lets it
+    work while we parse.
+    """
+
+    def __init__(self, args, input_file):
+        self.args = args
+        self.process = subprocess.Popen(args + [input_file], stdout=subprocess.PIPE,
+                                        bufsize=1024 * 1024)
+        self.stdout = self.process.stdout
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def read(self, size=-1):
+        return self.stdout.read(size)
+
+    def readline(self, size=-1):
+        return self.stdout.readline(size)
+
+    def close(self):
+        finished = self.process.poll() is not None
+        self.stdout.close()
+        if not finished:
+            self.process.terminate()
+        self.process.wait()
+        if finished and self.process.returncode:
+            raise IOError('%s exited with status %d' % (' '.join(self.args),
+                                                        self.process.returncode))
+
+
+def find_command(name):
+    """:return: whether the external command :param name: is available."""
+    if hasattr(shutil, 'which'):
+        return shutil.which(name) is not None
+    from distutils.spawn import find_executable
+    return find_executable(name) is not None
+
+
+# Each opener gets a file name or a binary file object (for URLs) and the
+# number of processes that may be used for decoding (None for a single one).
+
+def open_bz2(input, processes):
+    if processes and not hasattr(input, 'read'):
+        return io.BufferedReader(bz2index.BlockReader(input, processes))
+    return bz2.BZ2File(input)
+
+
+def open_gzip(input, processes):
+    if processes and not hasattr(input, 'read') and find_command('pigz'):
+        return PipeInput(['pigz', '-dc'], input)
+    if hasattr(input, 'read'):
+        return gzip.GzipFile(fileobj=input)
+    return gzip.GzipFile(input)
+
+
+def open_xz(input, processes):
+    if not hasattr(input, 'read') and find_command('xz'):
+        return PipeInput(['xz', '-dc', '-T%d' % (processes or 1)], input)
+    import lzma
+    return lzma.LZMAFile(input)
+
+
+def open_zstd(input, processes):
+    if not hasattr(input, 'read') and find_command('zstd'):
+        return PipeInput(['zstd', '-dcq'], input)
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd input needs the zstd command or the zstandard module')
+    if not hasattr(input, 'read'):
+        input = open(input, 'rb')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(input))
+
+
+def open_raw(input, processes):
+    if hasattr(input, 'read'):
+        return input
+    return open(input, 'rb', 1024 * 1024)
+
+
+##
+# Known input codecs: (magic bytes, file extensions, opener).
+# Add entries to support other formats.
+inputCodecs = [
+    (b'BZh', ('.bz2',), open_bz2),
+    (b'\x1f\x8b', ('.gz',), open_gzip),
+    (b'\xfd7zXZ\x00', ('.xz',), open_xz),
+    (b'\x28\xb5\x2f\xfd', ('.zst', '.zstd'), open_zstd),
+]
+
+
+def find_opener(input_file, head=None):
+    """
+    Choose the opener for :param input_file: by its extension, or else by
+    its first bytes :param head:. Anything unknown is read as raw XML.
+    """
+    for magic, extensions, opener in inputCodecs:
+        if input_file.endswith(extensions):
+            return opener
+    if head:
+        for magic, extensions, opener in inputCodecs:
+            if head.startswith(magic):
+                return opener
+    return open_raw
+
+
+def open_input(input_file, processes=None):
+    """
+    Open :param input_file: for reading lines of bytes.
+    It can be a local file or an http(s) URL, in which case the dump is
+    decompressed as it streams in. Compressed files are recognized by
+    extension or magic bytes (see inputCodecs).
+    :param processes: number of processes that may be used to decode a local
+    file, e.g. to decompress the blocks of a bz2 file in parallel.
+    """
+    if re.match(r'https?://', input_file):
+        input = io.BufferedReader(HTTPInput(input_file), HTTPInput.chunk_size)
+        return find_opener(input_file)(input, None)
+    with open(input_file, 'rb') as f:
+        head = f.read(6)
+    return find_opener(input_file, head)(input_file, processes)
+
+
+def load_templates(file, output_file=None, pages=None):
     """
     Load templates from :param file:.
-    :param output_file: file where to save templates and modules.
+    :param output_file: file where to save templates and modules, or an
+    open file.
+    :param pages: page iterator to use instead of scanning :param file:.
     """
     global templateNamespace, templatePrefix
     templatePrefix = templateNamespace + ':'
     global moduleNamespace, modulePrefix
     modulePrefix = moduleNamespace + ':'
     if output_file:
-        output = codecs.open(output_file, 'wb', 'utf-8')
-    for page_count, page_data in enumerate(pages_from(file)):
+        output = template_output(output_file)
+    for page_count, page_data in enumerate(pages or pages_from(file)):
         id, title, ns, page = page_data
         if not output_file and (not templateNamespace or
                                 not moduleNamespace):  # do not know it yet
@@ -2470,102 +2970,1051 @@ def load_templates(file, output_file=None):
                         moduleNamespace = title[:colon]
                         modulePrefix = title[:colon + 1]
         if ns in templateKeys:
-            text = ''.join(page)
+            text = page.decode('utf-8')
             define_template(title, text)
             # save templates and modules to file
             if output_file:
-                output.write('<page>\n')
-                output.write('   <title>%s</title>\n' % title)
-                output.write('   <ns>%s</ns>\n' % ns)
-                output.write('   <id>%s</id>\n' % id)
-                output.write('   <text>')
-                for line in page:
-                    output.write(line)
-                output.write('   </text>\n')
-                output.write('</page>\n')
+                write_template(output, id, title, ns, text)
         if page_count and page_count % 100000 == 0:
             logging.info("Preprocessed %d pages", page_count)
+    if output_file and output is not output_file:
+        output.close()
+        logging.info("Saved %d templates to '%s'", len(templates), output_file)
+
+
+def template_output(output_file):
+    """
+    :return: :param output_file: opened for saving templates, unless it is
+    already an open file (shared by several inputs).
+    """
+    if hasattr(output_file, 'write'):
+        return output_file
+    return codecs.open(output_file, 'wb', 'utf-8')
+
+
+def write_template(output, id, title, ns, text):
+    output.write('<page>\n')
+    output.write('   <title>%s</title>\n' % title)
+    output.write('   <ns>%s</ns>\n' % ns)
+    output.write('   <id>%s</id>\n' % id)
+    output.write('   <text>')
+    output.write(text)
+    output.write('</text>\n')
+    output.write('</page>\n')
+
+
+# ----------------------------------------------------------------------
+# Byte ranges of uncompressed dumps
+
+##
+# Read uncompressed XML files by byte ranges, each parsed and extracted by
+# an extract process, instead of passing every page through the mapper
+split_xml = False
+
+##
+# Approximate size of the byte ranges
+split_chunk_size = 16 * 1024 * 1024
+
+RangeJob = namedtuple('RangeJob', 'input_file start end page_num')
+
+_mapped = {}            # input file -> mmap, in each extract process
+
+
+def xml_ranges(input_file, chunk_size):
+    """
+    Cut an uncompressed XML file into byte ranges of about :param chunk_size:
+    that start at a <page> tag (the first one starts at 0).
+    :return: list of (start, end), or None if :param input_file: is not a
+    local uncompressed file.
+    """
+    if input_file == '-' or re.match(r'https?://', input_file) or not os.path.isfile(input_file):
+        return None
+    with open(input_file, 'rb') as f:
+        if find_opener(input_file, f.read(6)) is not open_raw:
+            return None
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = [0]
+        try:
+            for pos in range(chunk_size, size, chunk_size):
+                if pos <= offsets[-1]:
+                    continue
+                found = data.find(b'<page>', pos)
+                if found < 0:
+                    break
+                offsets.append(found)
+        finally:
+            data.close()
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def range_pages(input_file, start, end):
+    """
+    :return: the pages in bytes [:param start:, :param end:) of the
+    uncompressed :param input_file:, mapped once in each process.
+    """
+    if input_file not in _mapped:
+        with open(input_file, 'rb') as f:
+            _mapped[input_file] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return pages_from(io.BytesIO(_mapped[input_file][start:end]))
+
+
+# ----------------------------------------------------------------------
+# Parallel template pre-pass
+
+##
+# Approximate size of the chunks of input scanned by each process
+template_chunk_size = 64 * 1024 * 1024
+
+
+def template_chunks(input_file, ranges):
+    """
+    Split the input into chunks that can be scanned independently: groups of
+    streams of a multistream dump (:param ranges:), or ranges of an
+    uncompressed file starting at <page> tags.
+    :return: list of (start, end, compressed), or None if the input cannot be
+    split.
+    """
+    chunks = []
+    if ranges:
+        start = ranges[0][0]
+        for _, end in ranges:
+            if end - start >= template_chunk_size or end == ranges[-1][1]:
+                chunks.append((start, end, True))
+                start = end
+        return chunks
+    split = xml_ranges(input_file, template_chunk_size)
+    return [(start, end, False) for start, end in split] if split else None
+
+
+def input_chunks(inputs, ranges):
+    """
+    Chunks of all :param inputs: for the template pre-pass: those of
+    template_chunks(), or else the whole file, e.g. each part of a dump split
+    in single-stream bz2 files.
+    :param ranges: the streams of each input, as for template_chunks().
+    :return: list of (input number, input_file, start, end, compressed), start
+    and end None for a whole file; None if some input can only be read once
+    (stdin).
+    """
+    if '-' in inputs:
+        return None
+    chunks = []
+    for n, name in enumerate(inputs):
+        for start, end, compressed in template_chunks(name, ranges[n]) or [(None, None, None)]:
+            chunks.append((n, name, start, end, compressed))
+    return chunks
+
+
+def chunk_templates(job):
+    """
+    Template pre-pass over a single chunk (run in a pool process).
+    :param job: (input_file, start, end, compressed, spool_path), start None
+    for the whole file.
+    :return: the templates as [(id, title, ns, text, redirect, definition)],
+    and the number of pages scanned; the other pages are spooled to
+    spool_path.
+    """
+    input_file, start, end, compressed, spool_path = job
+    if start is None:
+        input = open_input(input_file)
+    else:
+        with open(input_file, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        if compressed:
+            data = bz2.decompress(data)
+        input = io.BytesIO(data)
+    found = []
+    count = 0
+    spool = PageSpool(path=spool_path) if spool_path else None
+    for id, title, ns, page in pages_from(input):
+        count += 1
+        if ns in templateKeys:
+            text = page.decode('utf-8')
+            found.append((id, title, ns, text) + template_definition(text))
+        elif spool:
+            spool.add((id, title, ns, page))
+    input.close()
+    if spool:
+        spool.flush()
+        spool.close()
+    return found, count
+
+
+def parallel_templates(chunks, process_count, output_file=None, spool_dir=None):
+    """
+    Collect templates from :param chunks: of the inputs on a pool of processes.
+    Definitions are merged in input order, so that redefinitions are resolved
+    (and reported) as by load_templates().
+    :param chunks: list of (input_file, start, end, compressed, spool), as
+    returned by input_chunks(), with spool whether to spool the other pages.
+    :param output_file: file where to save templates and modules, or an
+    open file.
+    :param spool_dir: directory of the spool files.
+    :return: the spool file of each chunk, or None, in input order.
+    """
     if output_file:
+        output = template_output(output_file)
+    spools = [os.path.join(spool_dir, '%06d' % i) if spool else None
+              for i, (_, _, _, _, spool) in enumerate(chunks)]
+    jobs = [(input_file, start, end, compressed, path)
+            for (input_file, start, end, compressed, _), path in zip(chunks, spools)]
+    pool = Pool(process_count)
+    page_count = 0
+    try:
+        for found, count in pool.imap(chunk_templates, jobs):
+            for id, title, ns, text, redirect, definition in found:
+                add_template(title, redirect, definition)
+                if output_file:
+                    write_template(output, id, title, ns, text)
+            page_count += count
+            logging.info("Preprocessed %d pages", page_count)
+    finally:
+        pool.terminate()
+        pool.join()
+    if output_file and output is not output_file:
         output.close()
         logging.info("Saved %d templates to '%s'", len(templates), output_file)
+    return spools
+
+
+# ----------------------------------------------------------------------
+# Page filters
+
+##
+# Restricts the pages returned by pages_from(), None to read all pages
+pageFilter = None
+
+
+class PageFilter(object):
+    """
+    Selects pages by namespace, id or title while scanning the dump.
+    A page is accepted if it is in one of the namespaces and, when ids or
+    titles are given, if either its id or its title is listed.
+    Values are compared to the raw bytes of the page header, so that the text
+    of rejected pages is never decoded or copied.
+    """
+
+    def __init__(self, namespaces=None, ids=None, titles=None, templates=True):
+        """
+        :param namespaces: accepted namespace keys ('0', '14', ...).
+        :param ids: accepted page ids.
+        :param titles: accepted titles, as they appear in the wiki.
+        :param templates: accept templates and modules anyway (needed to
+        expand templates).
+        """
+        self.namespaces = frozenset(str(ns).encode('utf-8') for ns in namespaces) \
+            if namespaces is not None else None
+        self.ids = frozenset(str(id).encode('utf-8') for id in ids) \
+            if ids is not None else None
+        # titles are escaped in the dump
+        self.titles = frozenset(escape(title, {'"': '&quot;'}).encode('utf-8') for title in titles) \
+            if titles is not None else None
+        self.templates = frozenset(ns.encode('utf-8') for ns in templateKeys) \
+            if templates else frozenset()
+
+    def accept(self, ns, id, title):
+        if ns in self.templates:
+            return True
+        if self.namespaces is not None and ns not in self.namespaces:
+            return False
+        if self.ids is None and self.titles is None:
+            return True
+        return self.ids is not None and id in self.ids or \
+            self.titles is not None and title in self.titles
+
+
+def read_list(path):
+    """
+    :return: the non-empty lines of the UTF-8 file at :param path:.
+    """
+    with codecs.open(path, 'r', 'utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# ----------------------------------------------------------------------
+# Byte scanner
+
+# Size of the buffers read by pages_from()
+scan_chunk_size = 1024 * 1024
 
 
 def pages_from(input):
     """
     Scans input extracting pages.
-    :return: (id, title, namespace, page), page is a list of lines.
+    Pages are located in large byte buffers with bytes.find(), and only the
+    title, namespace and id are decoded; the text is left for the consumer.
+    Pages rejected by pageFilter are skipped before anything is decoded.
+    :return: (id, title, namespace, text), text is the UTF-8 encoded wikitext
+    of the last revision.
     """
-    # we collect individual lines, since str.join() is significantly faster
-    # than concatenation
-    page = []
-    id = None
-    ns = '0'
+    buf = b''
+    pos = 0             # start of the unscanned part of buf
+    search = 0          # where to resume looking for </page>
     last_id = None
-    inText = False
-    redirect = False
-    for line in input:
-        line = line.decode('utf-8')
-        if '<' not in line:  # faster than doing re.search()
-            if inText:
-                page.append(line)
+    eof = False
+    while True:
+        start = buf.find(b'<page>', pos)
+        end = buf.find(b'</page>', max(start, search)) if start >= 0 else -1
+        if end < 0:
+            if eof:
+                break
+            # keep only what may still be part of a page
+            if start < 0:
+                keep = max(pos, len(buf) - len('<page>'))
+            else:
+                keep = start
+            chunk = input.read(scan_chunk_size)
+            eof = not chunk
+            search = max(0, len(buf) - keep - len('</page>'))
+            buf = buf[keep:] + chunk
+            pos = 0
             continue
-        m = tagRE.search(line)
-        if not m:
+        pos = end + len('</page>')
+        search = pos
+        revision = buf.find(b'<revision', start, end)
+        if revision < 0:
+            # no revisions, as in templates files: the header ends at <text
+            revision = buf.find(b'<text', start, end)
+            if revision < 0:
+                revision = end
+            text = revision
+        else:
+            # keep only the last revision (incremental dumps carry several)
+            text = buf.rfind(b'<text', revision, end)
+        if buf.find(b'<redirect', start, revision) >= 0:
             continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-            redirect = False
-        elif tag == 'id' and not id: # skip nested <id>
-            id = m.group(3)
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'ns':
-            ns = m.group(3)
-        elif tag == 'redirect':
-            redirect = True
-        elif tag == 'text':
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
-                inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif inText:
-            page.append(line)
-        elif tag == '/page':
-            if id != last_id and not redirect:
-                yield (id, title, ns, page)
-                last_id = id
-                ns = '0'
-            id = None
-            page = []
+        id = _tag_bytes(buf, b'id', start, revision)
+        if id is None or id == last_id:
+            continue
+        last_id = id
+        title = _tag_bytes(buf, b'title', start, revision)
+        ns = _tag_bytes(buf, b'ns', start, revision) or b'0'
+        if pageFilter and not pageFilter.accept(ns, id, title):
+            continue
+        id = id.decode('utf-8')
+        title = title.decode('utf-8') if title is not None else None
+        ns = ns.decode('utf-8')
+        if text < 0 or text == end:
+            continue
+        if buf.find(b'deleted=', text, buf.find(b'>', text, end)) >= 0:
+            # the text of the revision was deleted (incremental dumps)
+            continue
+        text = buf.find(b'>', text, end)
+        if buf[text - 1:text] == b'/':  # <text ... /> is empty
+            yield (id, title, ns, b'')
+        else:
+            yield (id, title, ns, buf[text + 1:buf.find(b'</text>', text, end)])
 
 
-def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+def _tag_bytes(buf, tag, start, end):
     """
-    :param input_file: name of the wikipedia dump file; '-' to read from stdin
-    :param template_file: optional file with template definitions.
-    :param out_file: directory where to store extracted data, or '-' for stdout
-    :param file_size: max size of each extracted file, or None for no max (one file)
-    :param file_compress: whether to compress files with bzip.
-    :param process_count: number of extraction processes to spawn.
+    :return: the content of the first <:param tag:> in buf[start:end], or None.
+    """
+    begin = buf.find(b'<' + tag + b'>', start, end)
+    if begin < 0:
+        return None
+    begin += len(tag) + 2
+    return buf[begin:buf.find(b'</' + tag + b'>', begin, end)]
+
+
+# ----------------------------------------------------------------------
+# Multistream dumps
+
+# Number of processes decompressing bz2 streams or blocks, 0 for one per
+# four extract processes
+reader_processes = 0
+
+
+def multistream_index_file(input_file):
+    """
+    :return: the ...-multistream-index.txt.bz2 file published next to the
+    multistream dump :param input_file:, or None if there is none.
+    """
+    index_file = re.sub(r'multistream(\d*)\.xml', r'multistream-index\1.txt', input_file)
+    if index_file == input_file or not os.path.isfile(index_file):
+        return None
+    return index_file
+
+
+def stream_page_ids(input_file):
+    """
+    :return: {stream offset: [page id, ...]} of the multistream dump
+    :param input_file:, from its ...-multistream-index.txt.bz2, or None.
+    """
+    index_file = multistream_index_file(input_file)
+    if not index_file:
+        return None
+    streams = {}
+    with bz2.BZ2File(index_file) as index:
+        for line in index:
+            # offset:page_id:title
+            offset, id, _ = line.split(b':', 2)
+            streams.setdefault(int(offset), []).append(id.decode('ascii'))
+    return streams
+
+
+def stream_ranges(input_file):
+    """
+    Byte ranges of the independent bz2 streams of a multistream dump, taken
+    from the .idx sidecar written while downloading, or from the
+    ...-multistream-index.txt.bz2 file published next to the dump.
+    :return: list of (start, end), or None if the streams are not known.
+    """
+    if not input_file.endswith('.bz2') or not os.path.isfile(input_file):
+        return None
+    size = os.path.getsize(input_file)
+    index = bz2index.load_index(input_file)
+    if index and len(index['streams']) > 1:
+        offsets = index['streams']
+    else:
+        index_file = multistream_index_file(input_file)
+        if not index_file:
+            return None
+        # lines are offset:page_id:title, one per page
+        offsets = set([0])
+        with bz2.BZ2File(index_file) as index:
+            for line in index:
+                offsets.add(int(line[:line.index(b':')]))
+    offsets = sorted(offsets) + [size]
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def stream_pages(job):
+    """
+    Decompress and scan a single stream (run in a reader process).
+    :param job: (input_file, start, end)
+    :return: list of pages as returned by pages_from().
+    """
+    input_file, start, end = job
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        data = bz2.decompress(f.read(end - start))
+    return list(pages_from(io.BytesIO(data)))
+
+
+def parallel_pages(input_file, ranges, process_count):
+    """
+    Same as pages_from() on the whole dump, but streams are decompressed and
+    scanned by :param process_count: processes. Pages are still returned in
+    input order, and only a few streams ahead are kept in memory.
+    """
+    pool = Pool(process_count)
+    jobs = ((input_file, start, end) for start, end in ranges)
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(pool.apply_async(stream_pages, (job,)))
+            if len(pending) < 2 * process_count:
+                continue
+            for page in pending.popleft().get():
+                yield page
+        while pending:
+            for page in pending.popleft().get():
+                yield page
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# ----------------------------------------------------------------------
+# Page index
+
+##
+# The page index of a dump is a SQLite database next to it, mapping each page
+# id and title to the place where the page starts:
+# - multistream bz2: byte range of the stream, and offset in the decompressed
+#   stream;
+# - other bz2 files: bit range of the block (see bz2index), and offset in the
+#   decompressed block (the page may continue in the following blocks);
+# - uncompressed XML: byte offsets of the start and the end of the page.
+# Other inputs can't be read at random and are not indexed.
+
+# Bytes at the start of each bz2 block used to complete the headers of pages
+# that begin at the end of the previous block
+page_index_head = 64 * 1024
+
+
+def page_index_path(input_file):
+    return input_file + '.pages'
+
+
+def page_headers(data):
+    """
+    Locate the pages starting in :param data:.
+    :return: list of (offset, id, title, ns), and the offset of the first page
+    whose header is cut at the end of data, or None.
+    """
+    headers = []
+    start = data.find(b'<page>')
+    while start >= 0:
+        revision = data.find(b'<revision', start)
+        if revision < 0:
+            return headers, start
+        id = _tag_bytes(data, b'id', start, revision)
+        if id is not None:
+            title = _tag_bytes(data, b'title', start, revision) or b''
+            ns = _tag_bytes(data, b'ns', start, revision) or b'0'
+            headers.append((start, int(id), title.decode('utf-8'), ns.decode('utf-8')))
+        start = data.find(b'<page>', revision)
+    return headers, None
+
+
+def index_unit(job):
+    """
+    Locate the pages of a stream, block or byte range (run in a pool process).
+    :param job: (input_file, kind, start, end)
+    :return: list of (offset, id, title, ns), and for blocks also the cut tail,
+    the head and the length of the decompressed block; for byte ranges the
+    ends of the pages instead of the tail.
+    """
+    input_file, kind, start, end = job
+    with open(input_file, 'rb') as f:
+        if kind == 'block':
+            data = bz2index.decode_block(f, start, end)
+        else:
+            f.seek(start)
+            data = f.read(end - start)
+            if kind == 'stream':
+                data = bz2.decompress(data)
+    headers, cut = page_headers(data)
+    if kind == 'range':
+        ends = [data.find(b'</page>', offset) for offset, _, _, _ in headers]
+        return headers, [end + len('</page>') if end >= 0 else None for end in ends], None, len(data)
+    if kind != 'block':
+        return headers, None, None, len(data)
+    # a <page> tag or a header may continue in the next block
+    tail = data[cut:] if cut is not None else data[-len('<page>') + 1:]
+    return headers, tail, data[:page_index_head], len(data)
+
+
+def build_page_index(input_file, process_count):
+    """
+    Index the pages of :param input_file: using :param process_count: processes.
+    :return: the path of the index, or None if the input can't be read at
+    random (gzip, xz or zstd).
+    """
+    ranges = stream_ranges(input_file)
+    scanner = None      # blocks of a bz2 file without .idx
+    if ranges:
+        kind = 'stream'
+        units = ranges
+    elif input_file.endswith('.bz2'):
+        kind = 'block'
+        index = bz2index.load_index(input_file)
+        if index:
+            units = [(start, end) for start, end, _, _ in index['blocks']]
+        else:
+            # only the block boundaries: the pool below decodes each block
+            # once, and its pages also fill in the .idx
+            scanner = bz2index.scan_file(input_file)
+            units = list(scanner.blocks)
+    else:
+        kind = 'raw'
+        units = xml_ranges(input_file, template_chunk_size)
+        if not units:
+            logging.warning("Can't index pages of '%s': it can't be read at random.", input_file)
+            return None
+    logging.info("Indexing pages of '%s' in %d %s ranges.", input_file, len(units), kind)
+    path = page_index_path(input_file)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    conn.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE pages (id INTEGER PRIMARY KEY, title TEXT, ns TEXT,'
+                 ' start INTEGER, end INTEGER, offset INTEGER)')
+    conn.executemany('INSERT INTO info VALUES (?, ?)',
+                     [('kind', kind), ('size', str(os.path.getsize(input_file)))])
+    jobs = [(input_file, kind if kind != 'raw' else 'range', start, end) for start, end in units]
+    pool = Pool(process_count)
+    previous = None     # (start, end, tail, length) of the previous block
+    page_count = 0
+    try:
+        for (start, end), (headers, tail, head, length) in zip(units, pool.imap(index_unit, jobs, 4)):
+            rows = []
+            if previous:
+                # pages beginning in the tail of the previous block
+                p_start, p_end, p_tail, p_length = previous
+                for offset, id, title, ns in page_headers(p_tail + head)[0]:
+                    if offset < len(p_tail):
+                        rows.append((id, title, ns, p_start, p_end, p_length - len(p_tail) + offset))
+            if kind == 'raw':
+                rows += [(id, title, ns, start + offset, start + page_end if page_end else None, 0)
+                         for (offset, id, title, ns), page_end in zip(headers, tail)]
+            else:
+                rows += [(id, title, ns, start, end, offset)
+                         for offset, id, title, ns in headers]
+            if kind == 'block':
+                previous = (start, end, tail, length)
+            if scanner:
+                # first and last page beginning in each block
+                for id, _, _, block, _, _ in rows:
+                    first = scanner.pages.get(block, (int(id), None))[0]
+                    scanner.pages[block] = (first, int(id))
+            # later revisions (incremental dumps) replace earlier ones
+            conn.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)', rows)
+            page_count += len(rows)
+    finally:
+        pool.terminate()
+        pool.join()
+    if scanner:
+        bz2index.save_index(input_file, scanner.index())
+    conn.execute('CREATE INDEX pages_title ON pages (title)')
+    conn.execute('CREATE INDEX pages_start ON pages (start)')
+    conn.commit()
+    conn.close()
+    os.rename(tmp, path)
+    logging.info("Indexed %d pages to '%s'", page_count, path)
+    return path
+
+
+def open_page_index(input_file):
+    """
+    :return: a connection to the page index of :param input_file:, or None if
+    there is no index or it doesn't match the file.
+    """
+    path = page_index_path(input_file)
+    if input_file == '-' or not os.path.isfile(path):
+        return None
+    conn = sqlite3.connect(path)
+    info = dict(conn.execute('SELECT key, value FROM info'))
+    if info.get('size') != str(os.path.getsize(input_file)):
+        conn.close()
+        return None
+    return conn
+
+
+def indexed_pages(input_file, ids=None, titles=None):
+    """
+    Read the pages with the given :param ids: or :param titles: (as they
+    appear in the dump) by seeking to them with the page index.
+    :return: pages as returned by pages_from(), in input order.
+    """
+    conn = open_page_index(input_file)
+    if not conn:
+        raise ValueError("no page index for '%s'" % input_file)
+    kind = dict(conn.execute('SELECT key, value FROM info'))['kind']
+    rows = set()
+    for column, values in (('id', ids), ('title', titles)):
+        values = list(values or ())
+        # stay below the SQLite limit on query parameters
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            rows.update(conn.execute('SELECT start, end, offset FROM pages WHERE %s IN (%s)'
+                                     % (column, ','.join('?' * len(batch))), batch))
+    conn.close()
+    return read_indexed(input_file, kind, sorted(rows))
+
+
+def read_indexed(input_file, kind, rows):
+    """
+    Read the pages at :param rows: (start, end, offset) of a page index of
+    :param kind:. The rows of a stream or block must be consecutive.
+    :return: pages as returned by pages_from().
+    """
+    if kind == 'block':
+        blocks = [(start, end) for start, end, _, _ in bz2index.load_index(input_file)['blocks']]
+        position = dict((start, i) for i, (start, end) in enumerate(blocks))
+    decoded = {}        # decompressed streams or blocks still in use
+    with open(input_file, 'rb') as f:
+        for start, end, offset in rows:
+            if kind == 'raw' and end:
+                f.seek(start)
+                data = f.read(end - start)
+            elif kind == 'raw':
+                # indexed without page ends
+                f.seek(start)
+                data = b''
+                while b'</page>' not in data:
+                    chunk = f.read(scan_chunk_size)
+                    if not chunk:
+                        break
+                    data += chunk
+            elif kind == 'stream':
+                if start not in decoded:
+                    decoded.clear()
+                    f.seek(start)
+                    decoded[start] = bz2.decompress(f.read(end - start))
+                data = decoded[start][offset:]
+            else:
+                i = position[start]
+                if i not in decoded:
+                    # next block: keep only the following ones, already decoded
+                    for key in list(decoded):
+                        if key < i:
+                            del decoded[key]
+                    if decoded and min(decoded) > i + 1:
+                        decoded.clear()
+                    decoded[i] = bz2index.decode_block(f, *blocks[i])
+                data = decoded[i][offset:]
+                while b'</page>' not in data and i + 1 < len(blocks):
+                    i += 1
+                    if i not in decoded:
+                        decoded[i] = bz2index.decode_block(f, *blocks[i])
+                    data += decoded[i]
+            end = data.find(b'</page>')
+            if end >= 0:
+                for page in pages_from(io.BytesIO(data[:end + len('</page>')])):
+                    yield page
+
+
+# ----------------------------------------------------------------------
+# Sampling
+
+##
+# Extract only a sample of the pages: a fraction of them (0 < sample < 1), or
+# a number of them (sample >= 1). The choice depends only on sample_seed and
+# the page ids: a fraction takes the pages whose hash is below it, a number
+# the articles with the smallest hashes. With a page index only the sampled
+# pages are read, and with the multistream index of a multistream dump only
+# the streams holding them, with the same result.
+sample = None
+sample_seed = 0
+
+
+def sample_hash(key):
+    """
+    :return: a value in [0, 1) for :param key: (bytes), the same in every run
+    with the same sample_seed.
+    """
+    seed = zlib.crc32(str(sample_seed).encode('ascii'))
+    return (zlib.crc32(key, seed) & 0xffffffff) / 4294967296.0
+
+
+def sampled(id):
+    """
+    :return: whether page :param id: is in a sample by fraction.
+    """
+    return sample_hash(id.encode('utf-8')) < sample
+
+
+def sample_key(id):
+    """
+    :return: the order of page :param id: in a sample of a given size.
+    """
+    return sample_hash(id.encode('utf-8')), int(id)
+
+
+def smallest_pages(pages, count):
+    """
+    :return: the :param count: articles of :param pages: first in sample
+    order, in that order. They are kept in memory until all pages are read.
+    """
+    heap = []
+    for page in pages:
+        if page[2] in templateKeys:
+            continue
+        key = sample_key(page[0])
+        # negated keys: the root is the largest of the smallest ones
+        entry = (-key[0], -key[1], page)
+        if len(heap) < count:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return [page for _, _, page in sorted(heap, reverse=True)]
+
+
+def sampled_pages(input_file):
+    """
+    Read a sample of the pages of :param input_file: with its page index, if
+    it has one, decompressing only the streams or blocks of sampled pages.
+    :return: the pages, or None if the dump must be scanned.
+    """
+    if input_file == '-' or not os.path.isfile(input_file):
+        return None
+    conn = open_page_index(input_file)
+    if not conn:
+        return None
+    kind = dict(conn.execute('SELECT key, value FROM info'))['kind']
+    query = 'SELECT id, start, end, offset FROM pages WHERE ns NOT IN (%s)' % \
+            ','.join('?' * len(templateKeys))
+    params = [int(ns) for ns in templateKeys]
+    if pageFilter and pageFilter.namespaces is not None:
+        query += ' AND ns IN (%s)' % ','.join('?' * len(pageFilter.namespaces))
+        params += [int(ns) for ns in pageFilter.namespaces]
+    try:
+        rows = [(sample_key(str(id)), (start, end, offset))
+                for id, start, end, offset in conn.execute(query, params)]
+    finally:
+        conn.close()
+    if sample < 1:
+        rows = sorted(row for key, row in rows if key[0] < sample)
+        logging.info("Sampling %d pages of '%s' with the page index.", len(rows), input_file)
+        return read_indexed(input_file, kind, rows)
+    logging.info("Sampling %d articles of '%s' with the page index.", sample, input_file)
+    return indexed_sample(input_file, kind, rows, int(sample))
+
+
+def sampled_streams(input_file, ranges, readers):
+    """
+    Read a sample of the pages of a multistream dump, decompressing only the
+    streams :param ranges: that hold sampled pages, found with the page ids
+    of its ...-multistream-index.txt.bz2. The pages are those chosen while
+    scanning the whole dump.
+    :param readers: number of processes decompressing streams.
+    :return: the pages, or None if the page ids of the streams aren't known.
+    """
+    ids = stream_page_ids(input_file)
+    ends = dict(ranges or ())
+    if not ids or any(start not in ends for start in ids):
+        return None
+    if sample < 1:
+        streams = [(start, ends[start]) for start in sorted(ids)
+                   if any(sampled(id) for id in ids[start])]
+        logging.info("Sampling %d of %d streams of '%s'.", len(streams), len(ranges), input_file)
+        return dump_pages(input_file, streams, readers) if streams else iter(())
+
+    # streams in the sample order of their pages, read in batches until they
+    # hold enough articles: some pages are templates, redirects or filtered
+    count = int(sample)
+    keys = sorted((sample_key(id), start) for start in ids for id in ids[start])
+    decoded = set()
+    articles = set()    # ids of the articles read
+    pages = []
+    done = 0
+    taken = 0           # articles among keys[:done]
+
+    def read(streams):
+        for page in dump_pages(input_file, streams, readers):
+            if page[2] not in templateKeys:
+                articles.add(page[0])
+            yield page
+
+    while done < len(keys) and taken < count:
+        batch = keys[done:done + 2 * (count - taken)]
+        streams = sorted(set(start for _, start in batch) - decoded)
+        decoded.update(streams)
+        if streams:
+            pages = smallest_pages(itertools.chain(pages, read([(start, ends[start])
+                                                                for start in streams])), count)
+        taken += sum(1 for key, _ in batch if str(key[1]) in articles)
+        done += len(batch)
+    logging.info("Sampled %d articles from %d of %d streams of '%s'.",
+                 len(pages), len(decoded), len(ranges), input_file)
+    return pages
+
+
+def indexed_sample(input_file, kind, rows, count):
+    """
+    :return: the :param count: articles first in sample order among the index
+    :param rows: (key, (start, end, offset)), as smallest_pages() would
+    select them from the whole dump. Rows are read in batches, since some of
+    them are skipped by pages_from() (redirects, filtered pages).
+    """
+    rows.sort(reverse=True)
+    found = []
+    while rows and len(found) < count:
+        batch = [rows.pop() for _ in range(min(len(rows), 2 * (count - len(found))))]
+        found += read_indexed(input_file, kind, sorted(row for _, row in batch))
+    return smallest_pages(found, count)
+
+
+# ----------------------------------------------------------------------
+# Page triage
+
+##
+# Pages skipped before extraction, judged on their raw wikitext:
+# - text shorter than triageMinSize or longer than triageMaxSize bytes;
+# - disambiguation pages, marked by __DISAMBIG__ or disambigTemplates;
+# - titles matching triageTitles (a regular expression);
+# - pages in triageCategories (only the categories written in the page, not
+#   those added by its templates).
+triageMinSize = 0
+triageMaxSize = None
+triageDisambig = False
+triageTitles = None
+triageCategories = None
+
+disambigTemplates = ['Disambig', 'Disambiguation', 'Dab', 'Disamb', 'Hndis', 'Geodis',
+                     'Numberdis', '消歧义', '消歧義', '曖昧さ回避', 'Aimai']
+
+triageReasons = ('size', 'disambiguation', 'title', 'category')
+
+##
+# The namespace of categories, key=14 in the siteinfo header.
+categoryNamespace = 'Category'
+
+triageDisambigRE = None
+triageCategoryRE = None
+
+
+def triage_enabled():
+    return bool(triageMinSize or triageMaxSize or triageDisambig or
+                triageTitles or triageCategories)
+
+
+def category_name(name):
+    """
+    Normalize a category name: spaces for underscores, first letter upper case.
+    """
+    name = name.replace('_', ' ').strip()
+    return name[:1].upper() + name[1:]
+
+
+def triage_rules():
+    """
+    Compile the triage rules, once the siteinfo is known.
+    """
+    global triageDisambigRE, triageCategoryRE
+    names = b'|'.join(re.escape(name.encode('utf-8')) for name in disambigTemplates)
+    triageDisambigRE = re.compile(br'__DISAMBIG__|\{\{\s*(?:' + names + br')\s*[|}]',
+                                  re.IGNORECASE)
+    prefixes = b'|'.join(re.escape(prefix.encode('utf-8'))
+                         for prefix in set(['Category', categoryNamespace]))
+    triageCategoryRE = re.compile(br'\[\[\s*(?:' + prefixes + br')\s*:\s*([^\]|]+)',
+                                  re.IGNORECASE)
+
+
+def triage(title, page):
+    """
+    Cheap checks of a page before extraction.
+    :param page: the raw wikitext, as bytes.
+    :return: the reason for skipping the page, or None to extract it.
+    """
+    if len(page) < triageMinSize or triageMaxSize and len(page) > triageMaxSize:
+        return 'size'
+    if triageDisambig and triageDisambigRE.search(page):
+        return 'disambiguation'
+    if triageTitles and triageTitles.search(title):
+        return 'title'
+    if triageCategories:
+        for m in triageCategoryRE.finditer(page):
+            if category_name(m.group(1).decode('utf-8', 'replace')) in triageCategories:
+                return 'category'
+    return None
+
+
+def triaged(title, page, counters):
+    """
+    :return: whether to skip the page, counting the reason in :param counters:
+    (shared values by reason), or False if triage is disabled.
+    """
+    if counters is None:
+        return False
+    reason = triage(title, page)
+    if reason:
+        counter = counters[reason]
+        with counter.get_lock():
+            counter.value += 1
+        return True
+    return False
+
+
+# ----------------------------------------------------------------------
+# Page spool
+
+##
+# Collect templates and extract articles in a single pass over the dump, keeping
+# the pages in a compressed temporary file in between. Otherwise the dump is
+# read a second time after collecting templates.
+spool_pages = True
+spool_batch_size = 4 * 1024 * 1024
+
+
+class PageSpool(object):
+    """
+    Temporary store for the non-template pages seen while collecting
+    templates, written in zlib-compressed batches. Iterating over it returns
+    the pages in the same order, as pages_from() would.
+    """
+
+    def __init__(self, dir=None, path=None):
+        """
+        :param dir: directory for the temporary file.
+        :param path: use this (new) file instead, to be read by another process.
+        """
+        if path:
+            self.file = open(path, 'w+b')
+        else:
+            self.file = tempfile.TemporaryFile(prefix='pages', dir=dir)
+        self.batch = []
+        self.size = 0
+        self.count = 0
+
+    def record(self, pages):
+        """
+        Pass :param pages: through, spooling those that are not templates.
+        """
+        for page in pages:
+            if page[2] not in templateKeys:
+                self.add(page)
+            yield page
+        self.flush()
+
+    def add(self, page):
+        self.batch.append(page)
+        self.size += len(page[3])
+        self.count += 1
+        if self.size > spool_batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            data = zlib.compress(pickle.dumps(self.batch, pickle.HIGHEST_PROTOCOL), 1)
+            self.file.write(struct.pack('>Q', len(data)))
+            self.file.write(data)
+        self.batch = []
+        self.size = 0
+
+    def __iter__(self):
+        self.file.seek(0)
+        return read_spool(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+def read_spool(file):
+    """
+    :return: the pages spooled to :param file: by a PageSpool.
+    """
+    while True:
+        header = file.read(8)
+        if not header:
+            break
+        data = file.read(struct.unpack('>Q', header)[0])
+        for page in pickle.loads(zlib.decompress(data)):
+            yield page
+
+
+def spooled_pages(paths):
+    """
+    :return: the pages spooled to the files :param paths:, removing each file
+    once read.
+    """
+    for path in paths:
+        with open(path, 'rb') as file:
+            for page in read_spool(file):
+                yield page
+        os.remove(path)
+
+
+def open_dump(input_file, readers, ranges=None):
+    """
+    :return: the input stream of :param input_file:, bz2 blocks decompressed
+    by :param readers: processes unless its streams :param ranges: are read
+    in parallel instead.
+    """
+    if input_file == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin)  # bytes in Python 3
+    return open_input(input_file, None if ranges else readers)
+
+
+def read_siteinfo(input):
+    """
+    Collect the siteinfo at the start of :param input:.
     """
     global urlbase
     global knownNamespaces
     global templateNamespace, templatePrefix
     global moduleNamespace, modulePrefix
+    global categoryNamespace
 
-    if input_file == '-':
-        input = sys.stdin
-    else:
-        input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
-
-    # collect siteinfo
     for line in input:
         line = line.decode('utf-8')
         m = tagRE.search(line)
@@ -2585,31 +4034,164 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
             elif re.search('key="828"', line):
                 moduleNamespace = m.group(3)
                 modulePrefix = moduleNamespace + ':'
+            elif re.search('key="14"', line):
+                categoryNamespace = m.group(3)
         elif tag == '/siteinfo':
             break
 
-    if Extractor.expand_templates:
+
+def dump_pages(input_file, ranges, readers, input=None):
+    """
+    :return: the pages of :param input_file:, read from :param input: if
+    already open.
+    """
+    if ranges:
+        if input:
+            input.close()
+        logging.info("Reading %d streams with %d processes.", len(ranges), readers)
+        for page in parallel_pages(input_file, ranges, readers):
+            yield page
+        return
+    if input is None:
+        input = open_dump(input_file, readers)
+    try:
+        for page in pages_from(input):
+            yield page
+    finally:
+        input.close()
+
+
+def selected_pages(input_file, page_index, process_count):
+    """
+    :return: the pages of :param input_file: selected by id or title in
+    pageFilter, read with the page index, or None if they must be scanned.
+    :param page_index: whether to build the index if missing.
+    """
+    if input_file == '-' or not os.path.isfile(input_file):
+        return None
+    index = open_page_index(input_file)
+    if index:
+        index.close()
+    elif page_index:
+        index = build_page_index(input_file, process_count)
+    if index and pageFilter and \
+            (pageFilter.ids is not None or pageFilter.titles is not None):
+        logging.info("Reading selected pages with the page index.")
+        return indexed_pages(input_file,
+                             [int(id) for id in pageFilter.ids or ()],
+                             [title.decode('utf-8') for title in pageFilter.titles or ()])
+    return None
+
+
+def input_name(input_file):
+    """
+    :return: the name of :param input_file: without directory and compression
+    extension, e.g. enwiki-20170801-pages-articles1.xml-p10p30302
+    """
+    name = os.path.basename(input_file.rstrip('/'))
+    for _, exts, _ in inputCodecs:
+        for ext in exts:
+            if name.endswith(ext):
+                return name[:-len(ext)]
+    return name
+
+
+def process_dump(input_file, template_file, out_file, file_size, file_compress,
+                 process_count, template_store=None, page_index=False, per_input=False):
+    """
+    :param input_file: name or http(s) URL of the wikipedia dump file; '-' to read from stdin.
+    Also a list of them, e.g. the parts of a dump, extracted one after the
+    other by the same processes, with the templates of all of them.
+    :param template_file: optional file with template definitions.
+    :param out_file: directory where to store extracted data, or '-' for stdout
+    :param file_size: max size of each extracted file, or None for no max (one file)
+    :param file_compress: whether to compress files with bzip.
+    :param process_count: number of extraction processes to spawn.
+    :param template_store: optional template store to use, or to create
+    after loading the templates.
+    :param page_index: whether to index the pages of the dump, if not yet
+    indexed. With an index, pages selected by id or title are read directly.
+    :param per_input: store the data extracted from each input in its own
+    subdirectory of :param out_file:, named by input_name().
+    """
+    global templateStore
+
+    inputs = list(input_file) if isinstance(input_file, (list, tuple)) else [input_file]
+
+    # multistream dumps are decompressed and scanned in parallel by streams,
+    # other bz2 files by blocks
+    readers = reader_processes or max(1, process_count // 4)
+    ranges = [stream_ranges(name) if name != '-' else None for name in inputs]
+    # uncompressed files are parsed by the extract processes
+    # (not for a sample of a given size, chosen among all pages)
+    splits = [xml_ranges(name, split_chunk_size) if split_xml and not (sample and sample >= 1) else None
+              for name in inputs]
+
+    # collect siteinfo, the same in all parts of a dump
+    input = open_dump(inputs[0], readers, ranges[0])
+    read_siteinfo(input)
+
+    spools = {}         # input number -> pages spooled by the template pre-pass
+    cleanup = []        # spools and spool directories to remove at the end
+    spool_root = out_file if out_file != '-' else None
+    if Extractor.expand_templates and template_store and os.path.exists(template_store):
+        templateStore = TemplateStore(template_store)
+        logging.info("Using %d templates from '%s'", len(templateStore), template_store)
+    elif Extractor.expand_templates:
         # preprocess
         template_load_start = default_timer()
-        if template_file:
-            if os.path.exists(template_file):
+        if template_file or template_store:
+            if template_file and os.path.exists(template_file):
                 logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", template_file)
-                file = fileinput.FileInput(template_file, openhook=fileinput.hook_compressed)
+                file = open_input(template_file)
                 load_templates(file)
                 file.close()
             else:
-                if input_file == '-':
+                if '-' in inputs and not spool_pages:
                     # can't scan then reset stdin; must error w/ suggestion to specify template_file
                     raise ValueError("to use templates with stdin dump, must supply explicit template-file")
-                logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
-                load_templates(input, template_file)
-                input.close()
-                input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+                output = template_output(template_file) if template_file else None
+                chunks = input_chunks(inputs, ranges) if process_count > 1 else None
+                if chunks and len(chunks) > 1:
+                    # scan the chunks of all inputs in parallel, each process
+                    # spooling its own pages
+                    logging.info("Preprocessing %d inputs to collect template definitions: this may take some time.", len(inputs))
+                    logging.info("Scanning %d chunks with %d processes.", len(chunks), process_count)
+                    input.close()
+                    spool_dir = None
+                    if spool_pages and not all(splits):
+                        spool_dir = tempfile.mkdtemp(prefix='spool', dir=spool_root)
+                        cleanup.append(spool_dir)
+                    paths = parallel_templates([(name, start, end, compressed, spool_dir and not splits[n])
+                                                for n, name, start, end, compressed in chunks],
+                                               process_count, output, spool_dir)
+                    for n in range(len(inputs)):
+                        if spool_dir and not splits[n]:
+                            spools[n] = spooled_pages([path for (i, _, _, _, _), path in zip(chunks, paths)
+                                                       if i == n])
+                else:
+                    for n, name in enumerate(inputs):
+                        logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", name)
+                        pages = dump_pages(name, ranges[n], readers, input)
+                        if spool_pages and not splits[n]:
+                            # read the dump only once: keep the other pages for the extraction
+                            spool = PageSpool(spool_root)
+                            cleanup.append(spool)
+                            load_templates(None, output, spool.record(pages))
+                            logging.info("Spooled %d pages (%d bytes)", spool.count, spool.file.tell())
+                            spools[n] = spool
+                        else:
+                            load_templates(None, output, pages)
+                        input = None
+                if output:
+                    output.close()
+                    logging.info("Saved %d templates to '%s'", len(templates), template_file)
         template_load_elapsed = default_timer() - template_load_start
         logging.info("Loaded %d templates in %.1fs", len(templates), template_load_elapsed)
+        if template_store:
+            save_template_store(template_store)
 
     # process pages
-    logging.info("Starting page extraction from %s.", input_file)
     extract_start = default_timer()
 
     # Parallel Map/Reduce:
@@ -2622,52 +4204,99 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
 
     if out_file == '-':
         out_file = None
+    if not out_file:
+        per_input = False
 
     worker_count = max(1, process_count)
 
     # load balancing
     max_spool_length = 10000
+    max_range_spool_length = 4 * worker_count   # byte ranges are much larger
     spool_length = Value('i', 0, lock=False)
+    article_count = Value('l', 0, lock=False)
 
     # reduce job that sorts and prints output
     reduce = Process(target=reduce_process,
                      args=(output_queue, spool_length,
-                           out_file, file_size, file_compress))
+                           os.path.join(out_file, input_name(inputs[0])) if per_input else out_file,
+                           file_size, file_compress, article_count))
     reduce.start()
 
     # initialize jobs queue
     jobs_queue = Queue(maxsize=maxsize)
 
+    # pages skipped by triage, by reason
+    triage_counts = None
+    if triage_enabled():
+        triage_rules()
+        triage_counts = dict((reason, Value('l', 0)) for reason in triageReasons)
+
     # start worker processes
     logging.info("Using %d extract processes.", worker_count)
     workers = []
     for i in range(worker_count):
         extractor = Process(target=extract_process,
-                            args=(i, jobs_queue, output_queue))
+                            args=(i, jobs_queue, output_queue, triage_counts))
         extractor.daemon = True  # only live while parent process lives
         extractor.start()
         workers.append(extractor)
 
     # Mapper process
     page_num = 0
-    for page_data in pages_from(input):
-        id, title, ns, page = page_data
-        if ns not in templateKeys:
-            # slow down
-            delay = 0
-            if spool_length.value > max_spool_length:
-                # reduce to 10%
-                while spool_length.value > max_spool_length/10:
-                    time.sleep(10)
-                    delay += 10
-            if delay:
-                logging.info('Delay %ds', delay)
-            job = (id, title, page, page_num)
-            jobs_queue.put(job) # goes to any available extract_process
+    for n, name in enumerate(inputs):
+        logging.info("Starting page extraction from %s.", name)
+        if n and per_input:
+            # the reducer moves to the next directory at this point
+            output_queue.put((page_num, NextFile(os.path.join(out_file, input_name(name)))))
             page_num += 1
-        page = None             # free memory
-
-    input.close()
+        pages = selected_pages(name, page_index, process_count)
+        sampled_index = False
+        if pages is None and sample:
+            pages = sampled_pages(name)
+            if pages is None and ranges[n]:
+                pages = sampled_streams(name, ranges[n], readers)
+            sampled_index = pages is not None
+        if pages is None and n in spools:
+            pages = spools[n]
+        else:
+            if pages is None and splits[n]:
+                # no page text goes through the queue
+                logging.info("Reading %d byte ranges in the extract processes.", len(splits[n]))
+                pages = ()
+                for start, end in splits[n]:
+                    while spool_length.value > max_range_spool_length:
+                        time.sleep(1)
+                    jobs_queue.put(RangeJob(name, start, end, page_num))
+                    page_num += 1
+            if pages is None:
+                pages = dump_pages(name, ranges[n], readers, input)
+            elif input:
+                input.close()
+        input = None
+        if sample is not None and sample >= 1 and not sampled_index:
+            pages = smallest_pages(pages, int(sample))
+        for page_data in pages:
+            id, title, ns, page = page_data
+            if ns not in templateKeys and not (sample is not None and sample < 1 and not sampled(id)):
+                # slow down
+                delay = 0
+                if spool_length.value > max_spool_length:
+                    # reduce to 10%
+                    while spool_length.value > max_spool_length/10:
+                        time.sleep(10)
+                        delay += 10
+                if delay:
+                    logging.info('Delay %ds', delay)
+                job = (id, title, page, page_num)
+                jobs_queue.put(job) # goes to any available extract_process
+                page_num += 1
+            page = None             # free memory
+
+    for spool in cleanup:
+        if isinstance(spool, PageSpool):
+            spool.close()
+        else:
+            shutil.rmtree(spool)
 
     # signal termination
     for _ in workers:
@@ -2680,54 +4309,87 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     output_queue.put(None)
     # wait for it to finish
     reduce.join()
+    if reduce.exitcode:
+        raise IOError('the output process failed (exit code %d)' % reduce.exitcode)
 
     extract_duration = default_timer() - extract_start
-    extract_rate = page_num / extract_duration
+    extract_rate = article_count.value / extract_duration
     logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
-                 process_count, page_num, extract_duration, extract_rate)
+                 process_count, article_count.value, extract_duration, extract_rate)
+    if triage_counts:
+        logging.info("Skipped by triage: %s", ', '.join(
+            '%d %s' % (triage_counts[reason].value, reason) for reason in triageReasons))
 
 
 # ----------------------------------------------------------------------
 # Multiprocess support
 
 
-def extract_process(i, jobs_queue, output_queue):
+def extract_process(i, jobs_queue, output_queue, triage_counts=None):
     """Pull tuples of raw page content, do CPU/regex-heavy fixup, push finished text
     :param i: process id.
     :param jobs_queue: where to get jobs.
     :param output_queue: where to queue extracted text for output.
+    :param triage_counts: shared counters of the pages skipped by triage, by
+    reason, or None to extract all pages.
     """
     while True:
-        job = jobs_queue.get()  # job is (id, title, page, page_num)
-        if job:
+        job = jobs_queue.get()  # job is (id, title, page, page_num) or a RangeJob
+        if isinstance(job, RangeJob):
+            output_queue.put((job.page_num, extract_range(job, triage_counts)))
+        elif job:
             id, title, page, page_num = job
+            if triaged(title, page, triage_counts):
+                output_queue.put((page_num, ''))
+                continue
             try:
                 out = StringIO()                 # memory buffer
                 e = Extractor(*job[:3]) # (id, title, page)
                 page = None              # free memory
                 e.extract(out)
                 text = out.getvalue()
-            except Exception as e:
-                print(e)
+            except Exception:
                 text = ''
-                traceback.print_exc()
-                logging.error('Processing page: %s %s', id, title)
+                logging.exception('Processing page: %s %s', id, title)
             output_queue.put((page_num, text))
         else:
             logging.debug('Quit extractor')
             break
-    out.close()
+
+
+def extract_range(job, triage_counts=None):
+    """
+    Extract the pages in a byte range of an uncompressed dump.
+    :param job: a RangeJob.
+    :param triage_counts: as for extract_process().
+    :return: the list of extracted texts.
+    """
+    texts = []
+    for id, title, ns, page in range_pages(job.input_file, job.start, job.end):
+        if ns in templateKeys or sample is not None and sample < 1 and not sampled(id):
+            continue
+        if triaged(title, page, triage_counts):
+            continue
+        try:
+            out = StringIO()                 # memory buffer
+            Extractor(id, title, page).extract(out)
+            texts.append(out.getvalue())
+        except Exception:
+            logging.exception('Processing page: %s %s', id, title)
+            texts.append('')
+    return texts
 
 
 report_period = 10000           # progress report period
 def reduce_process(output_queue, spool_length,
-                   out_file=None, file_size=0, file_compress=True):
+                   out_file=None, file_size=0, file_compress=True, article_count=None):
     """Pull finished article text, write series of files (or stdout)
     :param output_queue: text to be output.
     :param spool_length: spool length.
     :param out_file: filename where to print.
     :param file_size: max file size.
     :param file_compress: whether to compress output.
+    :param article_count: shared value set to the number of articles written.
     """
 
     if out_file:
@@ -2742,17 +4404,32 @@ def reduce_process(output_queue, spool_length,
     # FIXME: use a heap
     spool = {}        # collected pages
     next_page = 0     # sequence numbering of page
+    articles = 0      # pages written (a byte range holds many, skipped ones are empty)
+    reported = 0
     while True:
         if next_page in spool:
-            output.write(spool.pop(next_page))
+            text = spool.pop(next_page)
+            if isinstance(text, NextFile):
+                # next input, extracted into its own directory
+                output.close()
+                output = OutputSplitter(text, file_size, file_compress)
+            elif isinstance(text, list):
+                # all the pages of a byte range
+                for page_text in text:
+                    output.write(page_text)
+                articles += sum(1 for page_text in text if page_text)
+            elif text:
+                output.write(text)
+                articles += 1
             next_page += 1
             # tell mapper our load:
             spool_length.value = len(spool)
             # progress report
-            if next_page % report_period == 0:
-                interval_rate = report_period / (default_timer() - interval_start)
+            if articles - reported >= report_period:
+                interval_rate = (articles - reported) / (default_timer() - interval_start)
                 logging.info("Extracted %d articles (%.1f art/s)",
-                             next_page, interval_rate)
+                             articles, interval_rate)
+                reported = articles
                 interval_start = default_timer()
         else:
             # mapper puts None to signal finish
@@ -2770,6 +4447,8 @@ def reduce_process(output_queue, spool_length,
                               next_page, next_page == page_num)
     if output != sys.stdout:
         output.close()
+    if article_count is not None:
+        article_count.value = articles
 
 
 # ----------------------------------------------------------------------
@@ -2780,17 +4459,23 @@ minFileSize = 200 * 1024
 
 def main():
     global urlbase, acceptedNamespaces
-    global templateCache, escape_doc
+    global templateCache, escape_doc, pageFilter, split_xml
+    global sample, sample_seed
+    global triageMinSize, triageMaxSize, triageDisambig, triageTitles, triageCategories
 
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=__doc__)
-    parser.add_argument("input",
-                        help="XML wiki dump file")
+    parser.add_argument("input", nargs="+",
+                        help="XML wiki dump files or glob patterns, extracted one after the "
+                        "other, or http(s) URL to extract while downloading")
     groupO = parser.add_argument_group('Output')
     groupO.add_argument("-o", "--output", default="text",
                         help="directory for extracted files (or '-' for dumping to stdout)")
 
+    groupO.add_argument("--per-input", action="store_true",
+                        help="with several inputs, extract each into a subdirectory of the "
+                        "output directory named after it")
     groupO.add_argument("--lang", default="en",
                         help="segment language")
     groupO.add_argument("-b", "--bytes", default="1M",
@@ -2798,6 +4483,10 @@ def main():
                         metavar="n[KMG]")
     groupO.add_argument("-c", "--compress", action="store_true",
                         help="compress output files using bzip")
+    groupO.add_argument("--merge-into", metavar="CORPUS",
+                        help="after extracting an incremental dump, replace the documents "
+                        "with the same page ids in this previously extracted corpus, and remove "
+                        "those of its redirects and deleted pages")
 
     groupP = parser.add_argument_group('Processing')
     groupP.add_argument("--html", action="store_true",
@@ -2810,8 +4499,40 @@ def main():
                         help="preserve lists")
     groupP.add_argument("-ns", "--namespaces", default="", metavar="ns1,ns2",
                         help="accepted namespaces")
+    groupP.add_argument("--filter-namespaces", metavar="ns1,ns2",
+                        help="only extract pages in these namespaces (keys, e.g. 0,14)")
+    groupP.add_argument("--filter-ids", metavar="FILE",
+                        help="only extract the pages whose ids are listed in FILE, one per line "
+                        "(with --filter-titles, pages listed in either file)")
+    groupP.add_argument("--filter-titles", metavar="FILE",
+                        help="only extract the pages whose titles are listed in FILE, one per line "
+                        "(with --filter-ids, pages listed in either file)")
+    groupP.add_argument("--sample", metavar="n[%]",
+                        help="extract a sample of the pages, chosen by id: a fraction (0.01 or 1%%) "
+                        "or a number of them; with a page index or a multistream index only "
+                        "they are read")
+    groupP.add_argument("--sample-seed", type=int, default=0,
+                        help="seed choosing the sampled pages (default %(default)s)")
+    groupP.add_argument("--min-text-bytes", type=int, default=0, metavar="n",
+                        help="skip pages whose wikitext is shorter than n bytes")
+    groupP.add_argument("--max-text-bytes", type=int, metavar="n",
+                        help="skip pages whose wikitext is longer than n bytes")
+    groupP.add_argument("--skip-disambig", action="store_true",
+                        help="skip disambiguation pages")
+    groupP.add_argument("--skip-titles", metavar="REGEX",
+                        help="skip pages whose titles match REGEX, e.g. '^List of '")
+    groupP.add_argument("--skip-categories", metavar="cat1,cat2",
+                        help="skip pages in these categories (as written in the page)")
+    groupP.add_argument("--split-xml", action="store_true",
+                        help="parse uncompressed XML files by byte ranges in the extract processes")
+    groupP.add_argument("--page-index", action="store_true",
+                        help="index the pages of the dump (in FILE.pages) if not yet indexed; "
+                        "with an index, pages selected by --filter-ids or --filter-titles, "
+                        "or sampled by --sample, are read directly")
     groupP.add_argument("--templates",
                         help="use or create file containing templates")
+    groupP.add_argument("--template-store", metavar="FILE",
+                        help="use or create a database of pre-parsed templates")
     groupP.add_argument("--no-templates", action="store_false",
                         help="Do not expand templates")
     groupP.add_argument("--escapedoc", action="store_true",
@@ -2844,6 +4565,15 @@ def main():
 
     Extractor.expand_templates = args.no_templates
     escape_doc = args.escapedoc
+    split_xml = args.split_xml
+
+    triageMinSize = args.min_text_bytes
+    triageMaxSize = args.max_text_bytes
+    triageDisambig = args.skip_disambig
+    if args.skip_titles:
+        triageTitles = re.compile(args.skip_titles)
+    if args.skip_categories:
+        triageCategories = set(category_name(name) for name in args.skip_categories.split(','))
 
     try:
         power = 'kmg'.find(args.bytes[-1].lower()) + 1
@@ -2852,11 +4582,33 @@ def main():
             raise ValueError()
     except ValueError:
         logging.error('Insufficient or invalid size: %s', args.bytes)
-        return
+        return 1
 
     if args.namespaces:
         acceptedNamespaces = set(args.namespaces.split(','))
 
+    if args.sample:
+        try:
+            if args.sample.endswith('%'):
+                sample = float(args.sample[:-1]) / 100
+            elif '.' in args.sample:
+                sample = float(args.sample)
+            else:
+                sample = int(args.sample)
+            if sample <= 0 or isinstance(sample, float) and sample >= 1:
+                raise ValueError()
+        except ValueError:
+            logging.error('Invalid sample: %s', args.sample)
+            return 1
+        sample_seed = args.sample_seed
+
+    if args.filter_namespaces or args.filter_ids or args.filter_titles:
+        pageFilter = PageFilter(
+            args.filter_namespaces.split(',') if args.filter_namespaces else None,
+            read_list(args.filter_ids) if args.filter_ids else None,
+            read_list(args.filter_titles) if args.filter_titles else None,
+            templates=Extractor.expand_templates)
+
     FORMAT = '%(levelname)s: %(message)s'
     logging.basicConfig(format=FORMAT)
 
@@ -2866,7 +4618,9 @@ def main():
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    input_file = args.input
+    input_files = []
+    for pattern in args.input:
+        input_files += sorted(glob.glob(pattern)) or [pattern]
 
     if not Extractor.keepLinks:
         ignoreTag('a')
@@ -2881,11 +4635,12 @@ def main():
                 with open(args.templates) as file:
                     load_templates(file)
 
-        file = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
-        for page_data in pages_from(file):
-            id, title, ns, page = page_data
-            Extractor(id, title, page).extract(sys.stdout)
-        file.close()
+        for input_file in input_files:
+            file = open_input(input_file)
+            for page_data in pages_from(file):
+                id, title, ns, page = page_data
+                Extractor(id, title, page).extract(sys.stdout)
+            file.close()
         return
 
     output_path = args.output
@@ -2894,15 +4649,20 @@ def main():
             os.makedirs(output_path)
         except:
             logging.error('Could not create: %s', output_path)
-            return
+            return 1
+
+    process_dump(input_files, args.templates, output_path, file_size,
+                 args.compress, args.processes, args.template_store, args.page_index,
+                 args.per_input)
 
-    process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes)
+    if args.merge_into and output_path != '-':
+        merge_corpus(output_path, args.merge_into, input_files)
 
 
 if __name__ == '__main__':
     try:
-        main()
-    except Exception as e:
-        print(e)
-        pass
+        sys.exit(main())
+    except Exception:
+        # a non-zero status, so that scripts keep the dump of a failed extraction
+        logging.exception('Extraction failed')
+        sys.exit(1)
@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Distributed under terms of the MIT license.
+"""bz2 檔案的 stream/block 索引。
+
+bz2 檔由一個或多個 stream 組成 (multistream 版的 dump 每 100 頁一個 stream)，
+每個 stream 又分成多個獨立壓縮的 block。block 以 48 bit 的 magic 0x314159265359 開頭，
+stream 以 0x177245385090 結尾，兩者都不一定對齊 byte，所以要在 8 種位移下找。
+找到 block 的位置後，可以把單一個 block 包成一個完整的 bz2 stream 單獨解壓縮，
+因此一個很大的檔案也能直接切給多個 CPU 同時處理。
+
+索引存在檔案旁的 <檔名>.idx (JSON)：
+    {"size": 檔案大小,
+     "streams": [各 stream 開頭的 byte offset, ...],
+     "blocks": [[開頭 bit offset, 結尾 bit offset, 第一個 page id, 最後一個 page id], ...]}
+page id 是在這個 block 裡開始的 page，一個 page 都沒有開始的 block (大頁面的中間) 是 null。
+"""
+from __future__ import print_function
+import bz2
+import collections
+import io
+import json
+import os
+import re
+import sys
+from multiprocessing import Pool
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+
+pageIdRE = re.compile(br'<page>\s*<title>[^<]*</title>\s*(?:<ns>[^<]*</ns>\s*)?<id>(\d+)</id>')
+
+
+def _patterns(magic, kind):
+    """magic 在 bit 位移 0~7 時的樣子。
+    中間完整的 bytes 用 bytes.find 找，頭尾只有部分 bit 屬於 magic 的 byte 再用 mask 核對。
+    """
+    patterns = []
+    for shift in range(8):
+        width = 6 if shift == 0 else 7
+        window = (magic << (width * 8 - 48 - shift)).to_bytes(width, 'big')
+        head = 0xff >> shift
+        tail = (0xff << (width * 8 - 48 - shift)) & 0xff
+        if shift == 0:
+            patterns.append((kind, shift, window, 0, width, None, None))
+        else:
+            patterns.append((kind, shift, window[1:6], 1, width,
+                             (head, window[0]), (tail, window[6])))
+    return patterns
+
+
+PATTERNS = _patterns(BLOCK_MAGIC, 'block') + _patterns(EOS_MAGIC, 'eos')
+
+
+def find_magics(buf):
+    """找出 buf 裡所有完整出現的 magic，傳回 [(bit offset, 'block' 或 'eos'), ...]"""
+    found = []
+    for kind, shift, middle, moff, width, head, tail in PATTERNS:
+        i = buf.find(middle)
+        while i >= 0:
+            start = i - moff
+            if start >= 0 and start + width <= len(buf) and \
+                    (head is None or buf[start] & head[0] == head[1]) and \
+                    (tail is None or buf[start + width - 1] & tail[0] == tail[1]):
+                found.append((start * 8 + shift, kind))
+            i = buf.find(middle, i + 1)
+    found.sort()
+    return found
+
+
+class Scanner(object):
+    """依序接收檔案內容 (feed)，找出 stream 及 block 的邊界。
+
+    結尾已經確定的 block 放在 ready 裡，可以從另一個 thread 用 pop_ready 取走，
+    不必等整個檔案讀完就開始解壓縮找 page id。
+    """
+
+    def __init__(self):
+        self.pos = 0           # 已經讀到的 byte 數
+        self.tail = b''        # 上一次最後幾個 byte，magic 可能跨在兩次 feed 之間
+        self.last = -1         # 最後一個找到的 magic 的 bit offset
+        self.current = None    # 目前 block 的開頭
+        self.streams = [0]
+        self.blocks = []
+        self.ready = collections.deque()
+        self.pages = {}        # block 開頭 -> (第一個 page id, 最後一個 page id)
+
+    def feed(self, data):
+        buf = self.tail + data
+        base = (self.pos - len(self.tail)) * 8
+        for bit, kind in find_magics(buf):
+            bit += base
+            if bit <= self.last:
+                continue
+            self.last = bit
+            if self.current is not None:
+                self.blocks.append((self.current, bit))
+                self.ready.append((self.current, bit))
+            if kind == 'block':
+                self.current = bit
+            else:
+                # stream 結尾：magic 之後是 32 bit 的 combined CRC，再補到整個 byte
+                self.current = None
+                self.streams.append((bit + 48 + 32 + 7) // 8)
+        self.pos += len(data)
+        self.tail = buf[-6:]
+
+    def pop_ready(self):
+        blocks = []
+        while self.ready:
+            blocks.append(self.ready.popleft())
+        return blocks
+
+    def find_pages(self, path, start, end):
+        """解壓縮一個 block，記錄在其中開始的 page id。壞掉的 block (magic 誤判) 當作沒有 page。"""
+        try:
+            with open(path, 'rb') as f:
+                ids = pageIdRE.findall(decode_block(f, start, end))
+        except (IOError, OSError, ValueError, EOFError):
+            ids = []
+        self.pages[start] = (int(ids[0]), int(ids[-1])) if ids else (None, None)
+
+    def index(self):
+        return {'size': self.pos,
+                'streams': [offset for offset in self.streams if offset < self.pos],
+                'blocks': [[start, end] + list(self.pages.get(start, (None, None)))
+                           for start, end in self.blocks]}
+
+
+def read_bits(f, start, end):
+    """讀出檔案中 [start, end) 這一段 bit，傳回整數"""
+    f.seek(start // 8)
+    data = f.read((end + 7) // 8 - start // 8)
+    value = int.from_bytes(data, 'big') >> (len(data) * 8 - (end - start // 8 * 8))
+    return value & ((1 << (end - start)) - 1)
+
+
+def decode_block(f, start, end):
+    """單獨解壓縮 [start, end) 這個 block：
+    加上 stream header、結尾的 EOS magic，combined CRC 就是這個 block 自己的 CRC。
+    """
+    nbits = end - start
+    block = read_bits(f, start, end)
+    crc = (block >> (nbits - 80)) & 0xffffffff
+    value = (block << 80) | (EOS_MAGIC << 32) | crc
+    nbits += 80
+    pad = -nbits % 8
+    return bz2.decompress(b'BZh9' + (value << pad).to_bytes((nbits + pad) // 8, 'big'))
+
+
+def decode_job(job):
+    """(path, start, end) -> 解壓縮後的內容，給 process pool 用"""
+    path, start, end = job
+    with open(path, 'rb') as f:
+        return decode_block(f, start, end)
+
+
+class BlockReader(io.RawIOBase):
+    """用 processes 個 process 同時解壓縮各個 block，依序傳回解壓縮後的內容。
+
+    有索引就直接用，沒有的話邊讀邊找 block 的位置。同時只會有 2 * processes 個 block
+    在解壓縮或等著被讀取。通常包在 io.BufferedReader 裡一行一行讀。
+    """
+
+    def __init__(self, path, processes, chunk_size=1 << 20):
+        self.path = path
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.pending = collections.deque()
+        self.buffer = b''
+        self.offset = 0
+        index = load_index(path)
+        if index:
+            self.blocks = collections.deque((start, end) for start, end, _, _ in index['blocks'])
+            self.file = None
+        else:
+            self.blocks = collections.deque()
+            self.file = open(path, 'rb')
+            self.scanner = Scanner()
+
+    def readable(self):
+        return True
+
+    def fill(self):
+        """送出 block 直到同時處理的數量到達上限"""
+        if self.pool is None:
+            self.pool = Pool(self.processes)
+        while len(self.pending) < 2 * self.processes:
+            if not self.blocks and self.file:
+                data = self.file.read(self.chunk_size)
+                if data:
+                    self.scanner.feed(data)
+                    self.blocks.extend(self.scanner.pop_ready())
+                else:
+                    self.file.close()
+                    self.file = None
+                    # 最後一個 block 沒有結尾 (檔案不完整)，或根本沒有 bz2 stream
+                    if self.scanner.current is not None:
+                        raise IOError('{}: truncated bz2 file'.format(self.path))
+                    if len(self.scanner.streams) == 1:
+                        raise IOError('{}: not a bz2 file'.format(self.path))
+                continue
+            if not self.blocks:
+                break
+            start, end = self.blocks.popleft()
+            self.pending.append(self.pool.apply_async(decode_job, ((self.path, start, end),)))
+
+    def readinto(self, b):
+        while self.offset >= len(self.buffer):
+            self.fill()
+            if not self.pending:
+                return 0
+            self.buffer = self.pending.popleft().get()
+            self.offset = 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if self.pool is not None:
+            # 先等送出的 block 做完 (最多 2 * processes 個)：task handler 還在送的時候
+            # terminate() 可能會卡住
+            for result in self.pending:
+                result.wait()
+            self.pending.clear()
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        super(BlockReader, self).close()
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def save_index(path, index):
+    tmp = index_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp, index_path(path))
+
+
+def load_index(path):
+    """讀取 path 的索引，沒有索引或檔案大小不符時傳回 None"""
+    try:
+        with open(index_path(path)) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get('size') != os.path.getsize(path):
+        return None
+    return index
+
+
+def scan_file(path, chunk_size=1 << 20):
+    """只找出檔案裡 stream 及 block 的邊界 (不解壓縮)，傳回 Scanner；
+    各 block 的 page id 要另外填進 scanner.pages。
+    """
+    scanner = Scanner()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            scanner.feed(data)
+    return scanner
+
+
+def build_index(path, chunk_size=1 << 20):
+    """替已經下載好的檔案建索引 (下載時沒有建的話才需要)"""
+    scanner = scan_file(path, chunk_size)
+    for start, end in scanner.pop_ready():
+        scanner.find_pages(path, start, end)
+    save_index(path, scanner.index())
+    return scanner.index()
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        index = build_index(path)
+        print(path, len(index['streams']), 'streams', len(index['blocks']), 'blocks')
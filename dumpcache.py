@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Distributed under terms of the MIT license.
+"""本機的 dump 快取，所有語言及每次執行共用。
+
+驗證過的檔案以 sha1 存放 (objects/ab/abcdef...)，工作目錄 (<lang>/) 裡的只是 hard link，
+所以解析完把 <lang>/*.bz2 刪掉並不會刪到快取，重跑時直接 link 回來，不必重新下載。
+catalog.json 記錄每個檔案的語言、dump 日期、檔名、大小、hash 及最後使用時間：
+    {sha1: {'lang', 'date', 'filename', 'size', 'mtime', 'md5', 'sha1', 'used'}}
+
+清除的規則：
+1. 每個語言只保留最近 retention[lang] (預設 default_retention) 次 dump，
+   每日更新 (incr) 和完整的 dump 分開計算
+2. 總大小超過 cache_size 時，從最久沒用到的開始刪
+"""
+from __future__ import print_function
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+from time import time
+
+cache_dir = '.dumpcache'
+cache_size = None          # 快取總大小上限 (bytes)，None 表示不限
+default_retention = 2      # 每個語言保留最近幾次 dump
+retention = {}             # 個別語言的設定，例如 {'en': 1}
+
+dumpDateRE = re.compile(r'wiki-(\d{8})-')
+
+
+def dump_date(filename):
+    """enwiki-20170801-pages-articles1.xml-p10p30302.bz2 -> '20170801'"""
+    m = dumpDateRE.search(filename)
+    return m.group(1) if m else None
+
+
+def dump_kind(filename):
+    return 'incr' if '-incr.' in filename else 'full'
+
+
+def link(src, dst):
+    """建立 hard link，不同檔案系統時改為複製 (保留 mtime，ledger 才認得)"""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
+
+
+class DumpCache(object):
+
+    def __init__(self, root=None, size=None, keep=None):
+        self.root = root or cache_dir
+        self.size = size or cache_size
+        self.keep = dict(retention, **(keep or {}))
+
+    def object_path(self, sha1):
+        return os.path.join(self.root, 'objects', sha1[:2], sha1)
+
+    def catalog_path(self):
+        return os.path.join(self.root, 'catalog.json')
+
+    @contextlib.contextmanager
+    def catalog(self):
+        """鎖住並讀取 catalog，區塊結束時寫回去 (同時執行的多個 process 不會互相覆蓋)"""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, 'catalog.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.catalog_path()) as f:
+                    catalog = json.load(f)
+            except (IOError, ValueError):
+                catalog = {}
+            yield catalog
+            tmp = self.catalog_path() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(catalog, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.catalog_path())
+
+    def valid(self, entry):
+        """快取裡的檔案還在，而且大小及日期和存入時一樣"""
+        try:
+            st = os.stat(self.object_path(entry['sha1']))
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime == entry['mtime']
+
+    def lookup(self, lang=None, date=None, filename=None, sha1=None, size=None):
+        """找出符合條件的已驗證檔案，傳回 catalog 的 entry (加上 'path')，依檔名排序。
+        date 為 'latest' 時只傳回各語言最新一次完整 dump 的檔案。
+        """
+        with self.catalog() as catalog:
+            entries = [e for e in catalog.values()
+                       if (lang is None or e['lang'] == lang) and
+                       (filename is None or e['filename'] == filename) and
+                       (sha1 is None or e['sha1'] == sha1) and
+                       (size is None or e['size'] == size) and self.valid(e)]
+            if date == 'latest':
+                entries = [e for e in entries if dump_kind(e['filename']) == 'full']
+                latest = {}
+                for e in entries:
+                    latest[e['lang']] = max(latest.get(e['lang'], ''), e['date'])
+                entries = [e for e in entries if e['date'] == latest[e['lang']]]
+            elif date is not None:
+                entries = [e for e in entries if e['date'] == date]
+            now = time()
+            for e in entries:
+                e['used'] = now
+        return [dict(e, path=self.object_path(e['sha1']))
+                for e in sorted(entries, key=lambda e: e['filename'])]
+
+    def fetch(self, path, lang, filename, size, md5=None, sha1=None):
+        """快取裡有這個檔案的話，把它 link 到 path 並傳回 entry，否則傳回 None。
+        sha1 不知道時改用 語言+檔名+大小 找 (檔名裡有 dump 日期)。
+        """
+        if sha1:
+            found = self.lookup(sha1=sha1, size=size)
+        else:
+            found = self.lookup(lang=lang, filename=filename, size=size)
+        found = [e for e in found if md5 is None or e['md5'] == md5]
+        if not found:
+            return None
+        entry = found[0]
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        for src, dst in ((entry['path'], path), (entry['path'] + '.idx', path + '.idx')):
+            if os.path.isfile(src):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                link(src, dst)
+        return entry
+
+    def store(self, path, lang, filename, digests, date=None):
+        """把驗證過的檔案 (及它的 .idx 索引) 搬進快取，原來的位置換成 hard link。
+        date 是檔名裡沒有日期時 (例如 xxwiki-latest-...) 使用的 dump 日期 (YYYYMMDD)。
+        """
+        sha1 = digests['sha1']
+        obj = self.object_path(sha1)
+        if not os.path.isdir(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+        for src, dst in ((path, obj), (path + '.idx', obj + '.idx')):
+            if not os.path.isfile(src) or os.path.exists(dst) and os.path.samefile(src, dst):
+                continue
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copy2(src, dst)   # 快取在另一個檔案系統上，只好複製一份
+            else:
+                link(dst, src)
+        st = os.stat(obj)
+        with self.catalog() as catalog:
+            catalog[sha1] = {'lang': lang, 'date': dump_date(filename) or date or '',
+                             'filename': filename,
+                             'size': st.st_size, 'mtime': st.st_mtime, 'md5': digests.get('md5'),
+                             'sha1': sha1, 'used': time()}
+            self.evict(catalog)
+
+    def evict(self, catalog):
+        """依照 retention 及 cache_size 刪除檔案 (在 catalog() 區塊裡呼叫)"""
+        remove = set(sha1 for sha1, e in catalog.items() if not self.valid(e))
+        groups = {}
+        for sha1, e in catalog.items():
+            groups.setdefault((e['lang'], dump_kind(e['filename'])), []).append(e)
+        for (lang, kind), entries in groups.items():
+            keep = sorted(set(e['date'] for e in entries), reverse=True)
+            keep = keep[:self.keep.get(lang, default_retention)]
+            remove.update(e['sha1'] for e in entries if e['date'] not in keep)
+        if self.size:
+            total = sum(e['size'] for sha1, e in catalog.items() if sha1 not in remove)
+            for e in sorted(catalog.values(), key=lambda e: e['used']):
+                if total <= self.size:
+                    break
+                if e['sha1'] not in remove:
+                    remove.add(e['sha1'])
+                    total -= e['size']
+        for sha1 in remove:
+            # 工作目錄裡的 hard link 不受影響，刪掉之後空間才會釋放
+            for fn in (self.object_path(sha1), self.object_path(sha1) + '.idx'):
+                if os.path.isfile(fn):
+                    os.remove(fn)
+            del catalog[sha1]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Look up verified dumps in the local cache.')
+    parser.add_argument('lang', nargs='?', help='language (default: all)')
+    parser.add_argument('--date', default='latest',
+                        help="dump date (YYYYMMDD), 'latest' (default) or 'all'")
+    parser.add_argument('--cache-dir', default=cache_dir, help='cache directory (default: %(default)s)')
+    args = parser.parse_args()
+
+    cache = DumpCache(args.cache_dir)
+    for entry in cache.lookup(args.lang, None if args.date == 'all' else args.date):
+        print(entry['path'], entry['filename'])
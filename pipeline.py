@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Distributed under terms of the MIT license.
+"""下載及解析多個語言的 dump，兩者同時進行。
+
+所有語言的分割檔排成一個佇列，一次下載一個 (Scheduler 會用多條連線下載同一個檔案)，
+下載好的檔案馬上交給 WikiExtractor 解析，解析的同時繼續下載下一個，不論是哪個語言。
+
+- 磁碟：已下載但還沒解析完的 dump 加上正在下載的，總大小不超過 disk_budget，
+  超過時暫停下載，等解析完的檔案刪掉再繼續 (只有一個檔案時一定可以下載)。
+  dump 同時放在 dumpcache 裡時，刪掉工作目錄的 link 並不會釋放空間，快取的大小由
+  --cache-size 控制。
+- CPU：所有解析工作共用 cpu_budget 個 process，每個檔案用 part_processes 個。
+- 每個檔案解析完執行 on_part (例如上傳)，一個語言全部完成後執行 on_lang。
+"""
+from __future__ import print_function
+import asyncio
+import glob
+import os
+import shlex
+import sys
+from multiprocessing import cpu_count
+
+import WikiDumper
+
+cpu_budget = cpu_count()
+part_processes = 8
+disk_budget = None            # bytes，None 表示不限
+extract_args = ['-b', '50m']  # 其他傳給 WikiExtractor.py 的參數
+
+extractor = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'WikiExtractor.py')
+
+
+class Pipeline(object):
+
+    def __init__(self, langs, date=None, cpus=None, processes=None, disk=None, args=None,
+                 on_part=None, on_lang=None, keep_dumps=False):
+        self.langs = langs
+        self.date = date
+        self.cpus = cpus or cpu_budget
+        self.processes = min(processes or part_processes, self.cpus)
+        self.disk = disk or disk_budget
+        self.args = extract_args if args is None else args
+        self.on_part = on_part
+        self.on_lang = on_lang
+        self.keep_dumps = keep_dumps
+        self.on_disk = 0
+        self.slots = None    # 在 run() 裡建立，才會屬於正在執行的 event loop
+        self.freed = None
+        self.remaining = {}
+        self.failed = []
+        self.failed_langs = set()
+        self.procs = set()   # 正在執行的 WikiExtractor
+
+    async def plan(self):
+        """所有語言要處理的檔案：已經下載好的 (ledger 裡驗證過的) 及要下載的"""
+        parts = []
+        for lang in self.langs:
+            infos = await WikiDumper.plan_async(lang, self.date)
+            downloading = set(info.path for info in infos)
+            ledger = WikiDumper.load_ledger(lang)
+            for path in sorted(glob.glob(os.path.join(lang, '*.bz2'))):
+                if path not in downloading and os.path.basename(path) in ledger and \
+                        not os.path.isfile(WikiDumper.part_path(path)):
+                    parts.append((lang, path, None))
+            parts += [(lang, info.path, info) for info in infos]
+            self.remaining[lang] = sum(1 for p in parts if p[0] == lang)
+        return parts
+
+    async def reserve(self, size):
+        async with self.freed:
+            while self.disk and self.on_disk and self.on_disk + size > self.disk:
+                await self.freed.wait()
+            self.on_disk += size
+
+    async def release(self, size):
+        async with self.freed:
+            self.on_disk -= size
+            self.freed.notify_all()
+
+    async def hook(self, command, **fields):
+        if command:
+            proc = await asyncio.create_subprocess_shell(command.format(**fields))
+            if await proc.wait():
+                print('{} failed'.format(command.format(**fields)), file=sys.stderr)
+
+    async def extract(self, lang, path, size):
+        output = path[:-len('.bz2')]
+        async with self.slots:
+            print('extracting {} with {} processes'.format(path, self.processes))
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, extractor, path, '-o', output, '--lang', lang,
+                '--processes', str(self.processes), *self.args)
+            self.procs.add(proc)
+            code = await proc.wait()
+            self.procs.discard(proc)
+        if code:
+            # 保留 dump，下次重跑時不必重新下載
+            self.failed.append(path)
+            self.failed_langs.add(lang)
+            print('{} failed ({})'.format(path, code), file=sys.stderr)
+        else:
+            await self.hook(self.on_part, lang=lang, dump=path, output=output)
+            if not self.keep_dumps:
+                for fn in (path, path + '.idx'):
+                    if os.path.isfile(fn):
+                        os.remove(fn)
+        await self.release(size)
+        self.remaining[lang] -= 1
+        if not self.remaining[lang]:
+            if lang in self.failed_langs:
+                # 少了某些檔案，不執行 on_lang (例如上傳)
+                print('{} failed, not running on_lang'.format(lang), file=sys.stderr)
+            else:
+                await self.hook(self.on_lang, lang=lang)
+
+    async def run(self):
+        if sys.version_info < (3, 8):
+            # WikiDumper.run() 用的是新的 event loop，要讓它也能等待子 process 結束
+            # (3.8 以後的 ThreadedChildWatcher 不需要)
+            asyncio.get_child_watcher().attach_loop(asyncio.get_event_loop())
+        self.slots = asyncio.Semaphore(max(1, self.cpus // self.processes))
+        self.freed = asyncio.Condition()
+        tasks = []
+        try:
+            parts = await self.plan()
+            for lang in self.langs:
+                if not self.remaining.get(lang):
+                    # 沒有要處理的檔案，不會有 extract() 執行 on_lang
+                    await self.hook(self.on_lang, lang=lang)
+            for lang, path, info in parts:
+                size = info.size if info else os.path.getsize(path)
+                await self.reserve(size)
+                if info:
+                    try:
+                        await WikiDumper.download_async([info])
+                    except Exception:
+                        await self.release(size)
+                        raise
+                tasks.append(asyncio.ensure_future(self.extract(lang, path, size)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 失敗或中斷時，結束還在解析的 WikiExtractor
+            for proc in self.procs:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    pass
+            for proc in self.procs:
+                await proc.wait()
+            self.procs.clear()
+        if self.failed:
+            raise RuntimeError('extraction failed ({}): {}'.format(
+                ', '.join(sorted(self.failed_langs)), ', '.join(self.failed)))
+
+
+def run_pipeline(langs, **kwargs):
+    return WikiDumper.run(Pipeline(langs, **kwargs).run())
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Download and extract Wikipedia dumps in a pipeline.')
+    parser.add_argument('langs', nargs='*', default=['zh', 'ja', 'en'],
+                        help='languages to process (default: zh ja en)')
+    parser.add_argument('--date', help='dump date (YYYYMMDD), default: the latest')
+    parser.add_argument('--cpus', type=int, default=cpu_budget,
+                        help='processes shared by all extractions (default: %(default)s)')
+    parser.add_argument('--part-processes', type=int, default=part_processes,
+                        help='processes per extracted part (default: %(default)s)')
+    parser.add_argument('--disk-budget', type=float,
+                        help='GB of downloaded but not yet extracted dumps to keep on disk')
+    parser.add_argument('--extract-args', default=' '.join(extract_args),
+                        help="extra WikiExtractor.py arguments (default: '%(default)s')")
+    parser.add_argument('--on-part',
+                        help='shell command run after each part, with {lang}, {dump} and {output}')
+    parser.add_argument('--on-lang', help='shell command run after each language, with {lang}')
+    parser.add_argument('--keep-dumps', action='store_true',
+                        help='do not delete dumps after extracting them')
+    args = parser.parse_args()
+
+    run_pipeline(args.langs, date=args.date, cpus=args.cpus, processes=args.part_processes,
+                 disk=int(args.disk_budget * 1024 ** 3) if args.disk_budget else None,
+                 args=shlex.split(args.extract_args), on_part=args.on_part,
+                 on_lang=args.on_lang, keep_dumps=args.keep_dumps)
@@ -1,8 +1,4 @@
 #!/bin/bash
 
-scripts/download.sh zh
-scripts/download.sh ja
-scripts/download.sh en
-scripts/extract.sh zh
-scripts/extract.sh ja
-scripts/extract.sh en
+# 下載及解析同時進行，見 pipeline.py
+python pipeline.py zh ja en
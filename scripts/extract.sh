@@ -1,7 +1,8 @@
 #!/bin/bash
+set -e
 
-for file in "$1"/*.bz2
-do
-    python WikiExtractor.py -b 50m --processes=4 "${file}" -o "${file%.bz2}" --lang $1
-    rm ${file}
-done
+# 解析 $1/ 裡所有的 dump，成功了才刪掉 dump (WikiExtractor 失敗時 exit code 不是 0)
+python WikiExtractor.py -b 50m --processes=4 "$1"/*.bz2 -o "$1" --per-input --lang "$1"
+rm "$1"/*.bz2
+# 下載時寫在旁邊的 bz2 索引及 ledger 不屬於 corpus
+rm -f "$1"/*.bz2.idx "$1"/ledger.json
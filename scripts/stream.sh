@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# 不把 bz2 存到硬碟，直接從網路解壓縮並解析
+for url in $(python WikiDumper.py --urls $1)
+do
+    name=$(basename "${url}" .bz2)
+    python WikiExtractor.py -b 50m --processes=4 "${url}" -o "$1/${name}" --lang $1
+done
@@ -0,0 +1,8 @@
+#!/bin/bash
+set -eo pipefail
+
+# 用每日的 adds-changes dump 更新已經解析好的 corpus ($2)，依 page id 取代舊的記錄
+# 下載、解析或合併失敗時保留 dump，不會刪掉
+file=$(python WikiDumper.py --incr "$1" | tail -n 1)
+python WikiExtractor.py -b 50m --processes=4 "${file}" -o "$2/$(basename "${file}" .xml.bz2)" --merge-into "$2" --lang "$1"
+rm "${file}"
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import bz2
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bz2index
+
+
+def pages(first, count):
+    rnd = random.Random(first)
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon', b'zeta', b'eta', b'theta']
+    return b''.join(b'<page>\n<title>P%d</title>\n<ns>0</ns>\n<id>%d</id>\n<text>%s</text>\n</page>\n'
+                    % (id, id, b' '.join(rnd.choice(words) for _ in range(200)))
+                    for id in range(first, first + count))
+
+
+class FindMagicsTest(unittest.TestCase):
+
+    def test_shifts(self):
+        for shift in range(8):
+            for magic, kind in ((bz2index.BLOCK_MAGIC, 'block'), (bz2index.EOS_MAGIC, 'eos')):
+                bits = 3 * 8 + shift
+                value = magic << (64 - shift)
+                buf = b'\x00\x00\x00' + value.to_bytes(14, 'big')
+                self.assertEqual(bz2index.find_magics(buf), [(bits, kind)])
+
+    def test_cut(self):
+        buf = bz2index.BLOCK_MAGIC.to_bytes(6, 'big')
+        self.assertEqual(bz2index.find_magics(buf[:5]), [])
+        self.assertEqual(bz2index.find_magics(buf), [(0, 'block')])
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dump.xml.bz2')
+        # two streams, the first one of several 100k blocks
+        self.data = [pages(1, 300), pages(301, 10)]
+        with open(self.path, 'wb') as f:
+            f.write(bz2.compress(self.data[0], 1) + bz2.compress(self.data[1], 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        index = bz2index.build_index(self.path, chunk_size=4096)
+        self.assertEqual(index, bz2index.load_index(self.path))
+        self.assertEqual(len(index['streams']), 2)
+        self.assertGreater(len(index['blocks']), 2)
+        with open(self.path, 'rb') as f:
+            decoded = [bz2index.decode_block(f, start, end) for start, end, _, _ in index['blocks']]
+        self.assertEqual(b''.join(decoded), b''.join(self.data))
+        self.assertEqual(index['blocks'][0][2], 1)
+        self.assertEqual(index['blocks'][-1][2:], [301, 310])
+
+    def test_block_reader(self):
+        reader = bz2index.BlockReader(self.path, 2, chunk_size=4096)
+        try:
+            self.assertEqual(reader.read(), b''.join(self.data))
+        finally:
+            reader.close()
+
+    def test_truncated(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for size in (len(data) // 2, 20):
+            with open(self.path, 'wb') as f:
+                f.write(data[:size])
+            reader = bz2index.BlockReader(self.path, 2, chunk_size=4096)
+            try:
+                with self.assertRaises(IOError):
+                    reader.read()
+            finally:
+                reader.close()
+
+    def test_stale(self):
+        bz2index.build_index(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(bz2.compress(pages(311, 1)))
+        self.assertIsNone(bz2index.load_index(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
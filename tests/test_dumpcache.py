@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dumpcache
+
+
+class DumpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.work = os.path.join(self.dir, 'work')
+        os.makedirs(self.work)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, **kwargs):
+        return dumpcache.DumpCache(os.path.join(self.dir, 'cache'), **kwargs)
+
+    def store(self, cache, lang, date, part=1, size=10, kind='pages-articles'):
+        filename = '{}wiki-{}-{}{}.xml.bz2'.format(lang, date, kind, part)
+        path = os.path.join(self.work, filename)
+        data = (hashlib.sha1(filename.encode('ascii')).digest() * size)[:size]
+        with open(path, 'wb') as f:
+            f.write(data)
+        cache.store(path, lang, filename, {'sha1': hashlib.sha1(data).hexdigest(),
+                                           'md5': hashlib.md5(data).hexdigest()})
+        return filename
+
+    def filenames(self, cache, **kwargs):
+        return [e['filename'] for e in cache.lookup(**kwargs)]
+
+    def test_fetch(self):
+        cache = self.cache()
+        filename = self.store(cache, 'en', '20170801')
+        path = os.path.join(self.work, filename)
+        os.remove(path)
+        entry = cache.fetch(path, 'en', filename, 10)
+        self.assertEqual(entry['filename'], filename)
+        self.assertTrue(os.path.samefile(path, entry['path']))
+        self.assertIsNone(cache.fetch(path, 'en', filename, 11))
+
+    def test_retention(self):
+        cache = self.cache(keep={'en': 1})
+        for date in ('20170701', '20170801'):
+            self.store(cache, 'en', date)
+            self.store(cache, 'ja', date)
+        self.store(cache, 'en', '20170802', part='', kind='pages-meta-hist-incr')
+        self.assertEqual(self.filenames(cache, lang='en'),
+                         ['enwiki-20170801-pages-articles1.xml.bz2',
+                          'enwiki-20170802-pages-meta-hist-incr.xml.bz2'])
+        self.assertEqual(len(self.filenames(cache, lang='ja')), 2)
+        self.assertEqual(self.filenames(cache, lang='ja', date='latest'),
+                         ['jawiki-20170801-pages-articles1.xml.bz2'])
+
+    def test_size(self):
+        cache = self.cache(size=25)
+        first = self.store(cache, 'en', '20170801', 1)
+        self.store(cache, 'en', '20170801', 2)
+        # used again: the second one is now the least recently used
+        self.assertEqual(self.filenames(cache, filename=first), [first])
+        self.store(cache, 'en', '20170801', 3)
+        self.assertEqual(self.filenames(cache), [first, 'enwiki-20170801-pages-articles3.xml.bz2'])
+
+    def test_invalid(self):
+        cache = self.cache()
+        filename = self.store(cache, 'en', '20170801')
+        entry = cache.lookup(filename=filename)[0]
+        with open(entry['path'], 'ab') as f:
+            f.write(b'changed')
+        self.assertEqual(cache.lookup(filename=filename), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import WikiDumper
+except ImportError:     # aiohttp or requests
+    WikiDumper = None
+
+
+@unittest.skipUnless(WikiDumper, 'aiohttp or requests is not installed')
+class TelemetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def test_events_on_stdout(self):
+        telemetry = WikiDumper.Telemetry(events='-', progress=True)
+        transfer = SimpleNamespace(info=SimpleNamespace(filename='a.xml.bz2'), size=100,
+                                   received=40, retries=0, stalls=0, st_time=datetime.now())
+        telemetry.start(transfer)
+        telemetry.report()
+        telemetry.retry(transfer, 'https://example.org/a.xml.bz2', IOError('reset'), False)
+        transfer.received = 100
+        telemetry.finish(transfer)
+        telemetry.close()
+        events = [json.loads(line)['event'] for line in sys.stdout.getvalue().splitlines()]
+        self.assertEqual(events, ['start', 'progress', 'total', 'retry', 'finish', 'total'])
+        self.assertIn('[a.xml.bz2] 40%', sys.stderr.getvalue())
+        self.assertIn('[a.xml.bz2] finished', sys.stderr.getvalue())
+
+
+@unittest.skipUnless(WikiDumper, 'aiohttp or requests is not installed')
+class AdjustTest(unittest.TestCase):
+
+    def scheduler(self, rate=None):
+        scheduler = WikiDumper.Scheduler(rate, per_host=4, connections=2,
+                                         sources=['https://a.example.org/'],
+                                         telemetry=WikiDumper.Telemetry(progress=False))
+        scheduler.active = set(range(scheduler.limit))
+        return scheduler
+
+    def test_probe(self):
+        scheduler = self.scheduler()
+        scheduler.adjust(100.0)
+        self.assertEqual((scheduler.limit, scheduler.probing), (3, True))
+        scheduler.active = set(range(3))
+        # faster with one more connection: keep probing
+        scheduler.adjust(150.0)
+        self.assertEqual((scheduler.limit, scheduler.probing), (4, True))
+        scheduler.active = set(range(4))
+        # no gain: back off and hold
+        scheduler.adjust(151.0)
+        self.assertEqual((scheduler.limit, scheduler.probing, scheduler.hold), (3, False, 6))
+        scheduler.adjust(151.0)
+        self.assertEqual((scheduler.limit, scheduler.hold), (3, 5))
+
+    def test_capacity(self):
+        scheduler = self.scheduler()
+        scheduler.limit = 4
+        scheduler.active = set(range(4))
+        scheduler.adjust(100.0)
+        self.assertEqual((scheduler.limit, scheduler.probing), (4, False))
+
+    def test_max_rate(self):
+        scheduler = self.scheduler(rate=100.0)
+        scheduler.adjust(95.0)
+        self.assertEqual(scheduler.limit, 2)
+        scheduler.adjust(120.0)
+        self.assertEqual(scheduler.limit, 1)
+
+
+DATA = os.urandom(1 << 20)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """serves DATA by ranges; drop=True closes the connection halfway through
+    every request longer than the probe, slow=True delays the probe"""
+
+    drop = False
+    slow = False
+    served = None   # [(start, end, bytes sent)]
+
+    def do_GET(self):
+        start, end = [int(x) for x in self.headers['Range'].split('=')[1].split('-')]
+        length = end + 1 - start
+        if self.slow and length <= WikiDumper.probe_size:
+            time.sleep(0.2)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(DATA)))
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        sent = length // 2 if self.drop and length > WikiDumper.probe_size else length
+        self.wfile.write(DATA[start:start + sent])
+        self.served.append((start, end, sent))
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(WikiDumper, 'aiohttp or requests is not installed')
+class FailoverTest(unittest.TestCase):
+    """a mirror dropping the connection mid-transfer: the segments go on from
+    the other one and the file still verifies"""
+
+    settings = {'probe_size': 64 * 1024, 'segment_size': 256 * 1024, 'min_split_size': 64 * 1024,
+                'chunk_size': 16 * 1024, 'initial_connections': 2, 'per_host_connections': 2,
+                'cache_enabled': False, 'index_bz2': False}
+
+    def server(self, **attrs):
+        attrs['served'] = []
+        handler = type('Handler', (RangeHandler,), attrs)
+        server = ThreadingServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return handler, 'http://127.0.0.1:%d/' % server.server_port
+
+    def setUp(self):
+        self.saved = dict((name, getattr(WikiDumper, name))
+                          for name in list(self.settings) + ['dump_host', 'mirrors'])
+        for name, value in self.settings.items():
+            setattr(WikiDumper, name, value)
+        self.servers = []
+        # the dropping one is the fastest to answer the probe: it gets the first segments
+        self.flaky, WikiDumper.dump_host = self.server(drop=True)
+        self.good, mirror = self.server(slow=True)
+        WikiDumper.mirrors = [mirror]
+        self.dir = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = io.StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        for name, value in self.saved.items():
+            setattr(WikiDumper, name, value)
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_failover(self):
+        path = os.path.join(self.dir, 'dump.bin')
+        info = WikiDumper.Download(WikiDumper.dump_host + 'xxwiki/dump.bin', self.dir, datetime(2024, 1, 2),
+                                   len(DATA), path, 'dump.bin', '1', hashlib.md5(DATA).hexdigest(),
+                                   hashlib.sha1(DATA).hexdigest())
+        events = os.path.join(self.dir, 'events.ndjson')
+        WikiDumper.run(WikiDumper.download_async([info], telemetry=WikiDumper.Telemetry(events=events)))
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.exists(WikiDumper.part_path(path)))
+        ledger = WikiDumper.load_ledger(self.dir)
+        self.assertEqual(ledger['dump.bin']['sha1'], hashlib.sha1(DATA).hexdigest())
+        # cut short by the dropping mirror, then resumed from the other one
+        self.assertTrue([1 for start, end, sent in self.flaky.served if sent < end + 1 - start])
+        self.assertTrue([1 for start, end, sent in self.good.served if start % WikiDumper.segment_size])
+        with open(events) as f:
+            kinds = [json.loads(line)['event'] for line in f]
+        self.assertIn('retry', kinds)
+        self.assertEqual(kinds[-2:], ['finish', 'total'])
+
+
+if __name__ == '__main__':
+    unittest.main()
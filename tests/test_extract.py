@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+from tests.test_pages import DUMP
+
+
+class ExtractRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dump.xml')
+        with open(self.path, 'wb') as f:
+            f.write(DUMP)
+        self.extract = WikiExtractor.Extractor.extract
+        WikiExtractor.lang = 'en'
+
+    def tearDown(self):
+        WikiExtractor.Extractor.extract = self.extract
+        shutil.rmtree(self.dir)
+
+    def test_error_logged(self):
+        def fail(self, out):
+            raise ValueError('broken page')
+        WikiExtractor.Extractor.extract = fail
+        job = WikiExtractor.RangeJob(self.path, 0, len(DUMP), 0)
+        with self.assertLogs(level='ERROR') as logs:
+            texts = WikiExtractor.extract_range(job)
+        self.assertEqual(texts, ['', ''])
+        self.assertIn('Processing page: 4 Alpha', logs.output[0])
+        self.assertIn('ValueError: broken page', logs.output[0])
+
+
+class ExitStatusTest(unittest.TestCase):
+
+    def test_failure(self):
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'WikiExtractor.py')
+        dir = tempfile.mkdtemp()
+        try:
+            proc = subprocess.Popen([sys.executable, script, os.path.join(dir, 'missing.xml'),
+                                     '-o', os.path.join(dir, 'out'), '-q'],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+        finally:
+            shutil.rmtree(dir)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b'Extraction failed', err)
+
+
+if __name__ == '__main__':
+    unittest.main()
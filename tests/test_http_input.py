@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+
+class NotFound(BaseHTTPRequestHandler):
+
+    requests = 0
+
+    def do_GET(self):
+        NotFound.requests += 1
+        self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(requests, 'requests is not installed')
+class HTTPInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), NotFound)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_client_error(self):
+        NotFound.requests = 0
+        start = time.time()
+        input = WikiExtractor.HTTPInput('http://127.0.0.1:%d/dump.xml' % self.server.server_port)
+        with self.assertRaises(IOError):
+            input.read(10)
+        input.close()
+        self.assertEqual(NotFound.requests, 1)
+        self.assertLess(time.time() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import mktime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import WikiDumper
+except ImportError:     # aiohttp or requests
+    WikiDumper = None
+
+DATE = '20240101'
+PREFIX = 'xxwiki-%s-' % DATE
+
+
+def dumpstatus(status='done'):
+    def files(*entries):
+        return dict((name, {'url': '/xxwiki/%s/%s' % (DATE, name), 'size': size,
+                            'md5': hashlib.md5(name.encode('ascii')).hexdigest()})
+                    for name, size in entries)
+    return json.dumps({'jobs': {
+        'articlesdump': {'status': status, 'updated': '2024-01-02 03:04:05', 'files': files(
+            (PREFIX + 'pages-articles1.xml-p1p100.bz2', 300),
+            (PREFIX + 'pages-articles2.xml-p101p300.bz2', 500),
+            (PREFIX + 'pages-articles1.xml-p1p100', 3000))},
+        'articlesmultistreamdump': {'status': status, 'updated': '2024-01-02 03:04:05', 'files': files(
+            (PREFIX + 'pages-articles-multistream1.xml-p1p100.bz2', 310),
+            (PREFIX + 'pages-articles-multistream-index1.txt-p1p100.bz2', 20))},
+    }}).encode('utf-8')
+
+
+class DumpStatus(BaseHTTPRequestHandler):
+    """dumpstatus.json with an ETag, 304 when it hasn't changed"""
+
+    body = b''
+    log = []    # (path, status)
+
+    def do_GET(self):
+        if self.path != '/xxwiki/%s/dumpstatus.json' % DATE:
+            DumpStatus.log.append((self.path, 404))
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(self.body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            DumpStatus.log.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        DumpStatus.log.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(WikiDumper, 'aiohttp or requests is not installed')
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), DumpStatus)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        DumpStatus.body = dumpstatus()
+        DumpStatus.log = []
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.saved = WikiDumper.dump_host, WikiDumper.manifest_dir
+        WikiDumper.dump_host = 'http://127.0.0.1:%d/' % self.server.server_port
+        WikiDumper.manifest_dir = os.path.join(self.dir, '.manifest')
+
+    def tearDown(self):
+        WikiDumper.dump_host, WikiDumper.manifest_dir = self.saved
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_load_manifest(self):
+        files = WikiDumper.load_manifest('xx', DATE)
+        self.assertEqual(sorted(f.filename for f in files),
+                         [PREFIX + 'pages-articles1.xml-p1p100.bz2', PREFIX + 'pages-articles2.xml-p101p300.bz2'])
+        f = [f for f in files if f.size == 300][0]
+        self.assertEqual(f.url, WikiDumper.dump_host + 'xxwiki/%s/%s' % (DATE, f.filename))
+        self.assertEqual(f.date, datetime(2024, 1, 2, 3, 4, 5))
+        self.assertEqual(f.md5, hashlib.md5(f.filename.encode('ascii')).hexdigest())
+        self.assertIsNone(f.index)
+
+    def test_multistream(self):
+        files = WikiDumper.load_manifest('xx', DATE, multistream=True)
+        self.assertEqual([f.filename for f in files], [PREFIX + 'pages-articles-multistream1.xml-p1p100.bz2'])
+        self.assertEqual(files[0].index, WikiDumper.dump_host + 'xxwiki/%s/%s' % (
+            DATE, PREFIX + 'pages-articles-multistream-index1.txt-p1p100.bz2'))
+
+    def test_done_is_cached(self):
+        # a finished dump doesn't change: read once
+        WikiDumper.load_manifest('xx', DATE)
+        WikiDumper.load_manifest('xx', DATE)
+        self.assertEqual([status for _, status in DumpStatus.log], [200])
+
+    def test_etag(self):
+        DumpStatus.body = dumpstatus('in-progress')
+        with self.assertRaises(ValueError):
+            WikiDumper.load_manifest('xx', DATE)
+        # unchanged: 304, still in progress
+        del DumpStatus.log[:]
+        with self.assertRaises(ValueError):
+            WikiDumper.load_manifest('xx', DATE)
+        self.assertEqual([status for _, status in DumpStatus.log], [304])
+        # finished since then
+        DumpStatus.body = dumpstatus()
+        self.assertEqual(len(WikiDumper.load_manifest('xx', DATE)), 2)
+        self.assertEqual([status for _, status in DumpStatus.log], [304, 200])
+
+    def test_prepare_wiki_url(self):
+        infos = WikiDumper.prepare_wiki_url('xx', DATE)
+        # largest first, numbered by part
+        self.assertEqual([(info.size, info.number) for info in infos], [(500, '2'), (300, '1')])
+        self.assertEqual(infos[0].path, os.path.join('xx', infos[0].filename))
+        self.assertEqual(infos[0].date, datetime(2024, 1, 2, 3, 4, 5))
+
+        # a file already verified in the ledger is not downloaded again
+        info = infos[1]
+        with open(info.path, 'wb') as f:
+            f.write(b'\0' * info.size)
+        mtime = mktime(info.date.timetuple())
+        os.utime(info.path, (mtime, mtime))
+        WikiDumper.record_ledger('xx', info.filename, {'size': info.size, 'mtime': mtime,
+                                                       'md5': info.md5, 'sha1': None})
+        self.assertEqual([i.filename for i in WikiDumper.prepare_wiki_url('xx', DATE)], [infos[0].filename])
+
+
+if __name__ == '__main__':
+    unittest.main()
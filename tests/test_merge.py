@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+
+INCR = b"""<mediawiki>
+  <page>
+    <title>Alpha</title>
+    <ns>0</ns>
+    <id>4</id>
+    <revision>
+      <id>14</id>
+      <text xml:space="preserve">Old text</text>
+    </revision>
+    <revision>
+      <id>24</id>
+      <text xml:space="preserve">New text</text>
+    </revision>
+  </page>
+  <page>
+    <title>Beta</title>
+    <ns>0</ns>
+    <id>6</id>
+    <redirect title="Alpha" />
+    <revision>
+      <id>26</id>
+      <text xml:space="preserve">#REDIRECT [[Alpha]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>Gamma</title>
+    <ns>0</ns>
+    <id>7</id>
+    <revision>
+      <id>27</id>
+      <text deleted="deleted" />
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+
+def doc(id, text):
+    return json.dumps({'title': 'Page %d' % id, 'id': str(id), 'text': text}) + '\n'
+
+
+class MergeCorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.dir, 'corpus')
+        self.write('AA/wiki_00', doc(4, 'old') + doc(6, 'old') + doc(8, 'kept'))
+        self.write('AA/wiki_01', doc(7, 'old'))
+        self.write('AB/wiki_00', doc(9, 'kept'))
+        self.write('update/AA/wiki_00', doc(4, 'new'))
+        self.incr = os.path.join(self.dir, 'incr.xml')
+        with open(self.incr, 'wb') as f:
+            f.write(INCR)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        path = os.path.join(self.corpus, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(os.path.join(self.corpus, path)) as f:
+            return [json.loads(line)['id'] for line in f]
+
+    def test_incr_pages(self):
+        with open(self.incr, 'rb') as f:
+            pages = list(WikiExtractor.pages_from(f))
+        self.assertEqual(pages, [('4', 'Alpha', '0', b'New text')])
+        self.assertEqual(WikiExtractor.dump_page_ids(self.incr), set(['4', '6', '7']))
+
+    def test_merge(self):
+        untouched = os.stat(os.path.join(self.corpus, 'AB/wiki_00')).st_ino
+        WikiExtractor.merge_corpus(os.path.join(self.corpus, 'update'), self.corpus, [self.incr])
+        self.assertEqual(self.read('AA/wiki_00'), ['8'])
+        self.assertEqual(self.read('AA/wiki_01'), [])
+        self.assertEqual(self.read('AB/wiki_00'), ['9'])
+        self.assertEqual(self.read('update/AA/wiki_00'), ['4'])
+        self.assertEqual(os.stat(os.path.join(self.corpus, 'AB/wiki_00')).st_ino, untouched)
+
+    def test_next_update(self):
+        WikiExtractor.merge_corpus(os.path.join(self.corpus, 'update'), self.corpus, [self.incr])
+        # the documents of the first update are replaced by the next one
+        self.write('update2/AA/wiki_00', doc(4, 'newer') + doc(9, 'newer'))
+        WikiExtractor.merge_corpus(os.path.join(self.corpus, 'update2'), self.corpus)
+        self.assertEqual(self.read('update/AA/wiki_00'), [])
+        self.assertEqual(self.read('AB/wiki_00'), [])
+        self.assertEqual(self.read('update2/AA/wiki_00'), ['4', '9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+from WikiExtractor import PageFilter
+from tests.test_pages import DUMP
+
+
+class PageFilterTest(unittest.TestCase):
+
+    def test_namespaces(self):
+        f = PageFilter(namespaces=['0'], templates=False)
+        self.assertTrue(f.accept(b'0', b'4', b'Alpha'))
+        self.assertFalse(f.accept(b'1', b'5', b'Talk:Alpha'))
+        self.assertFalse(f.accept(b'10', b'1', b'Template:Greet'))
+
+    def test_templates(self):
+        f = PageFilter(namespaces=['0'], ids=[4])
+        self.assertTrue(f.accept(b'10', b'1', b'Template:Greet'))
+
+    def test_ids_or_titles(self):
+        f = PageFilter(ids=[4], titles=['Beta'], templates=False)
+        self.assertTrue(f.accept(b'0', b'4', b'Alpha'))
+        self.assertTrue(f.accept(b'0', b'6', b'Beta'))
+        self.assertFalse(f.accept(b'0', b'7', b'Gamma'))
+
+    def test_escaped_titles(self):
+        f = PageFilter(titles=['AT&T "x"'], templates=False)
+        self.assertTrue(f.accept(b'0', b'8', b'AT&amp;T &quot;x&quot;'))
+
+
+class FilteredPagesTest(unittest.TestCase):
+    """The page index and the scanner select the same pages."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = WikiExtractor.pageFilter
+
+    def tearDown(self):
+        WikiExtractor.pageFilter = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_indexed_and_scanned(self):
+        path = os.path.join(self.dir, 'dump.xml')
+        with open(path, 'wb') as f:
+            f.write(DUMP)
+        WikiExtractor.pageFilter = PageFilter(ids=[5], titles=['Alpha'], templates=False)
+        scanned = list(WikiExtractor.pages_from(io.BytesIO(DUMP)))
+        WikiExtractor.build_page_index(path, 1)
+        indexed = list(WikiExtractor.selected_pages(path, False, 1))
+        self.assertEqual([page[0] for page in scanned], ['4', '5'])
+        self.assertEqual(indexed, scanned)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import bz2
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    mock = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bz2index
+import WikiExtractor
+from tests.test_pages import DUMP
+from tests.test_sample import make_dump
+
+
+class PageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data, opener=open):
+        path = os.path.join(self.dir, name)
+        with opener(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_raw(self):
+        path = self.write('dump.xml', DUMP)
+        self.assertEqual(WikiExtractor.build_page_index(path, 1),
+                         WikiExtractor.page_index_path(path))
+        pages = list(WikiExtractor.indexed_pages(path, ids=[4], titles=['Template:Greet']))
+        self.assertEqual([page[0] for page in pages], ['1', '4'])
+        self.assertEqual(pages[1][3], b"'''Alpha''' {{Greet|you}}")
+
+    def test_raw_page_ends(self):
+        path = self.write('dump.xml', DUMP)
+        WikiExtractor.build_page_index(path, 1)
+        conn = WikiExtractor.open_page_index(path)
+        for start, end in conn.execute('SELECT start, end FROM pages'):
+            self.assertTrue(DUMP[start:end].startswith(b'<page>'))
+            self.assertTrue(DUMP[start:end].endswith(b'</page>'))
+        conn.close()
+
+    @unittest.skipUnless(mock, 'unittest.mock not available')
+    def test_blocks(self):
+        # a single-stream bz2 without .idx: each block is decoded once, by the
+        # pool, which also fills in the page ids of the .idx
+        path = self.write('dump.xml.bz2', bz2.compress(make_dump(3000), 1))
+        with mock.patch.object(bz2index.Scanner, 'find_pages', side_effect=AssertionError):
+            WikiExtractor.build_page_index(path, 2)
+        blocks = bz2index.load_index(path)['blocks']
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(blocks[0][2], 1)
+        self.assertEqual(blocks[-1][3], 3000)
+        for (_, _, _, last), (_, _, first, _) in zip(blocks, blocks[1:]):
+            self.assertEqual(first, last + 1)
+        pages = list(WikiExtractor.indexed_pages(path, ids=[1, 1501, 2999]))
+        self.assertEqual([page[0] for page in pages], ['1', '1501', '2999'])
+
+    def test_not_seekable(self):
+        path = self.write('dump.xml.gz', DUMP, gzip.open)
+        self.assertIsNone(WikiExtractor.build_page_index(path, 1))
+        self.assertIsNone(WikiExtractor.open_page_index(path))
+        self.assertIsNone(WikiExtractor.selected_pages(path, True, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import bz2
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+
+DUMP = b"""<mediawiki>
+  <siteinfo>
+    <namespaces>
+      <namespace key="10" case="first-letter">Template</namespace>
+    </namespaces>
+  </siteinfo>
+  <page>
+    <title>Template:Greet</title>
+    <ns>10</ns>
+    <id>1</id>
+    <revision>
+      <id>11</id>
+      <text xml:space="preserve">Hello {{{1|world}}}!</text>
+    </revision>
+  </page>
+  <page>
+    <title>Template:Hi</title>
+    <ns>10</ns>
+    <id>2</id>
+    <redirect title="Template:Greet" />
+    <revision>
+      <id>12</id>
+      <text xml:space="preserve">#REDIRECT [[Template:Greet]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>Template:Sign</title>
+    <ns>10</ns>
+    <id>3</id>
+    <revision>
+      <id>13</id>
+      <text xml:space="preserve">Bye<noinclude> (doc)</noinclude></text>
+    </revision>
+  </page>
+  <page>
+    <title>Alpha</title>
+    <ns>0</ns>
+    <id>4</id>
+    <revision>
+      <id>14</id>
+      <text xml:space="preserve">first</text>
+    </revision>
+    <revision>
+      <id>15</id>
+      <text xml:space="preserve">'''Alpha''' {{Greet|you}}</text>
+    </revision>
+  </page>
+  <page>
+    <title>Talk:Alpha</title>
+    <ns>1</ns>
+    <id>5</id>
+    <revision>
+      <id>16</id>
+      <text xml:space="preserve" />
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+
+class PagesFromTest(unittest.TestCase):
+
+    def pages(self, data=DUMP, chunk_size=None):
+        saved = WikiExtractor.scan_chunk_size
+        if chunk_size:
+            WikiExtractor.scan_chunk_size = chunk_size
+        try:
+            return list(WikiExtractor.pages_from(io.BytesIO(data)))
+        finally:
+            WikiExtractor.scan_chunk_size = saved
+
+    def test_pages(self):
+        pages = self.pages()
+        self.assertEqual([(id, title, ns) for id, title, ns, _ in pages],
+                         [('1', 'Template:Greet', '10'), ('3', 'Template:Sign', '10'),
+                          ('4', 'Alpha', '0'), ('5', 'Talk:Alpha', '1')])
+        self.assertEqual(pages[0][3], b'Hello {{{1|world}}}!')
+
+    def test_last_revision(self):
+        alpha = [page for page in self.pages() if page[0] == '4'][0]
+        self.assertEqual(alpha[3], b"'''Alpha''' {{Greet|you}}")
+
+    def test_empty_text(self):
+        self.assertEqual(self.pages()[-1][3], b'')
+
+    def test_small_chunks(self):
+        # tags cut between reads
+        for chunk_size in (7, 13, 64):
+            self.assertEqual(self.pages(chunk_size=chunk_size), self.pages())
+
+
+class TemplatesFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = WikiExtractor.templates, WikiExtractor.redirects
+        WikiExtractor.templates = {}
+        WikiExtractor.redirects = {}
+
+    def tearDown(self):
+        WikiExtractor.templates, WikiExtractor.redirects = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.dir, 'templates.xml')
+        WikiExtractor.load_templates(None, path, WikiExtractor.pages_from(io.BytesIO(DUMP)))
+        saved = dict(WikiExtractor.templates)
+        self.assertEqual(len(saved), 2)
+
+        WikiExtractor.templates = {}
+        file = WikiExtractor.open_input(path)
+        try:
+            WikiExtractor.load_templates(file)
+        finally:
+            file.close()
+        self.assertEqual(len(WikiExtractor.templates), len(saved))
+        self.assertEqual(WikiExtractor.templates, saved)
+
+
+PART2 = b"""<mediawiki>
+  <page>
+    <title>Template:Other</title>
+    <ns>10</ns>
+    <id>6</id>
+    <revision>
+      <id>17</id>
+      <text xml:space="preserve">Other</text>
+    </revision>
+  </page>
+  <page>
+    <title>Beta</title>
+    <ns>0</ns>
+    <id>7</id>
+    <revision>
+      <id>18</id>
+      <text xml:space="preserve">{{Other}}</text>
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+
+class ParallelTemplatesTest(unittest.TestCase):
+    """The template pre-pass over the parts of a dump, each in a pool process."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = WikiExtractor.templates, WikiExtractor.redirects
+        WikiExtractor.templates = {}
+        WikiExtractor.redirects = {}
+        self.inputs = []
+        for n, data in enumerate((DUMP, PART2)):
+            path = os.path.join(self.dir, 'part%d.xml.bz2' % n)
+            with open(path, 'wb') as f:
+                f.write(bz2.compress(data))
+            self.inputs.append(path)
+
+    def tearDown(self):
+        WikiExtractor.templates, WikiExtractor.redirects = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_count(self):
+        # all the pages scanned, whether the others are spooled or not
+        for spool in (None, os.path.join(self.dir, 'spool')):
+            found, count = WikiExtractor.chunk_templates((self.inputs[0], None, None, None, spool))
+            self.assertEqual(len(found), 2)
+            self.assertEqual(count, 4)
+
+    def test_inputs(self):
+        chunks = WikiExtractor.input_chunks(self.inputs, [None, None])
+        self.assertEqual(chunks, [(0, self.inputs[0], None, None, None),
+                                  (1, self.inputs[1], None, None, None)])
+        self.assertIsNone(WikiExtractor.input_chunks(['-'], [None]))
+        paths = WikiExtractor.parallel_templates(
+            [(name, start, end, compressed, True) for _, name, start, end, compressed in chunks],
+            2, spool_dir=self.dir)
+        self.assertEqual(sorted(WikiExtractor.templates), ['Template:Greet', 'Template:Other', 'Template:Sign'])
+        pages = list(WikiExtractor.spooled_pages(paths))
+        self.assertEqual([page[0] for page in pages], ['4', '5', '7'])
+
+
+if __name__ == '__main__':
+    unittest.main()
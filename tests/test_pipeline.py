@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import pipeline
+    import WikiDumper
+except ImportError:     # aiohttp or requests
+    pipeline = None
+
+
+class Planned(pipeline.Pipeline if pipeline else object):
+    """Pipeline over parts already on disk, without looking up the dumps."""
+
+    def __init__(self, langs, parts, **kwargs):
+        super(Planned, self).__init__(langs, **kwargs)
+        self.parts = parts
+
+    async def plan(self):
+        for lang in self.langs:
+            self.remaining[lang] = sum(1 for part in self.parts if part[0] == lang)
+        return self.parts
+
+
+@unittest.skipUnless(pipeline, 'aiohttp or requests is not installed')
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.extractor = pipeline.extractor
+        # stands for WikiExtractor.py: never finishes
+        pipeline.extractor = os.path.join(self.dir, 'sleep.py')
+        with open(pipeline.extractor, 'w') as f:
+            f.write('import time\ntime.sleep(60)\n')
+        self.dump = os.path.join(self.dir, 'xxwiki-pages-articles1.xml.bz2')
+        with open(self.dump, 'wb') as f:
+            f.write(b'BZh9')
+
+    def tearDown(self):
+        pipeline.extractor = self.extractor
+        shutil.rmtree(self.dir)
+
+    def test_no_parts(self):
+        done = os.path.join(self.dir, '{lang}.done')
+        WikiDumper.run(Planned(['xx'], [], on_lang='touch ' + done).run())
+        self.assertTrue(os.path.isfile(done.format(lang='xx')))
+
+    def test_failed_part(self):
+        # stands for WikiExtractor.py: fails on the bad part
+        pipeline.extractor = os.path.join(self.dir, 'fail.py')
+        with open(pipeline.extractor, 'w') as f:
+            f.write("import sys\nsys.exit(1 if 'bad' in sys.argv[1] else 0)\n")
+        bad = os.path.join(self.dir, 'xxwiki-pages-articles2-bad.xml.bz2')
+        shutil.copy(self.dump, bad)
+        shutil.copy(self.dump, bad + '.idx')
+        done = os.path.join(self.dir, '{lang}.done')
+        p = Planned(['xx'], [('xx', self.dump, None), ('xx', bad, None)], processes=1, args=[],
+                    on_part='touch {dump}.done', on_lang='touch ' + done)
+        with self.assertRaises(RuntimeError):
+            WikiDumper.run(p.run())
+        self.assertEqual(p.failed, [bad])
+        # the dump of the failed part is kept, without running on_part
+        self.assertTrue(os.path.isfile(bad))
+        self.assertTrue(os.path.isfile(bad + '.idx'))
+        self.assertFalse(os.path.isfile(bad + '.done'))
+        self.assertFalse(os.path.isfile(self.dump))
+        self.assertTrue(os.path.isfile(self.dump + '.done'))
+        # and the language is not complete
+        self.assertFalse(os.path.isfile(done.format(lang='xx')))
+
+    def test_cancel(self):
+        p = Planned(['xx'], [('xx', self.dump, None)], processes=1, args=[])
+
+        async def cancel():
+            task = asyncio.ensure_future(p.run())
+            while not p.procs:
+                await asyncio.sleep(0.05)
+            procs = list(p.procs)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return procs
+
+        procs = WikiDumper.run(cancel())
+        self.assertTrue(procs)
+        for proc in procs:
+            self.assertIsNotNone(proc.returncode)
+        self.assertFalse(p.procs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import bz2
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+
+PAGE = """  <page>
+    <title>%s</title>
+    <ns>%d</ns>
+    <id>%d</id>%s
+    <revision>
+      <id>%d</id>
+      <text xml:space="preserve">Text of page %d</text>
+    </revision>
+  </page>
+"""
+
+
+def make_pages(count):
+    pages = []
+    for id in range(1, count + 1):
+        ns = 10 if id % 7 == 0 else 0
+        title = ('Template:T%d' if ns else 'Page %d') % id
+        redirect = '\n    <redirect title="Page 1" />' if id % 5 == 0 else ''
+        pages.append((PAGE % (title, ns, id, redirect, 1000 + id, id)).encode('utf-8'))
+    return pages
+
+
+def make_dump(count):
+    return b'<mediawiki>\n' + b''.join(make_pages(count)) + b'</mediawiki>\n'
+
+
+class SampleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = WikiExtractor.sample, WikiExtractor.sample_seed
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'dump.xml')
+        with open(self.path, 'wb') as f:
+            f.write(make_dump(200))
+
+    def tearDown(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = self.saved
+        shutil.rmtree(self.dir)
+
+    def scanned(self):
+        with open(self.path, 'rb') as f:
+            pages = list(WikiExtractor.pages_from(f))
+        if WikiExtractor.sample < 1:
+            return [page for page in pages
+                    if page[2] not in WikiExtractor.templateKeys and WikiExtractor.sampled(page[0])]
+        return WikiExtractor.smallest_pages(pages, WikiExtractor.sample)
+
+    def indexed(self):
+        pages = WikiExtractor.sampled_pages(self.path)
+        return [page for page in pages if page[2] not in WikiExtractor.templateKeys]
+
+    def test_hash(self):
+        WikiExtractor.sample_seed = 1
+        value = WikiExtractor.sample_hash(b'42')
+        self.assertTrue(0 <= value < 1)
+        self.assertEqual(WikiExtractor.sample_hash(b'42'), value)
+        WikiExtractor.sample_seed = 2
+        self.assertNotEqual(WikiExtractor.sample_hash(b'42'), value)
+
+    def test_no_index(self):
+        WikiExtractor.sample = 0.5
+        self.assertIsNone(WikiExtractor.sampled_pages(self.path))
+
+    def test_fraction(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = 0.3, 5
+        scanned = self.scanned()
+        self.assertTrue(20 < len(scanned) < 80)
+        WikiExtractor.build_page_index(self.path, 1)
+        self.assertEqual(self.indexed(), scanned)
+
+    def test_count(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = 12, 5
+        scanned = self.scanned()
+        self.assertEqual(len(scanned), 12)
+        keys = [WikiExtractor.sample_key(page[0]) for page in scanned]
+        self.assertEqual(keys, sorted(keys))
+        WikiExtractor.build_page_index(self.path, 1)
+        self.assertEqual(self.indexed(), scanned)
+
+    def test_count_all(self):
+        WikiExtractor.sample = 1000
+        articles = len([id for id in range(1, 201) if id % 7 and id % 5])
+        self.assertEqual(len(self.scanned()), articles)
+        WikiExtractor.build_page_index(self.path, 1)
+        self.assertEqual(len(self.indexed()), articles)
+
+
+class StreamSampleTest(SampleTest):
+
+    def setUp(self):
+        self.saved = WikiExtractor.sample, WikiExtractor.sample_seed
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'xxwiki-multistream.xml.bz2')
+        with open(os.path.join(self.dir, 'dump.xml'), 'wb') as f:
+            f.write(make_dump(200))
+        # streams of 10 pages, and their index: offset:id:title
+        pages = make_pages(200)
+        streams = [b'<mediawiki>\n'] + [b''.join(pages[i:i + 10]) for i in range(0, 200, 10)] + \
+            [b'</mediawiki>\n']
+        index = []
+        with open(self.path, 'wb') as f:
+            for n, stream in enumerate(streams):
+                offset = f.tell()
+                if 0 < n < len(streams) - 1:
+                    for id in range(n * 10 - 9, n * 10 + 1):
+                        index.append(b'%d:%d:T\n' % (offset, id))
+                f.write(bz2.compress(stream))
+        with open(os.path.join(self.dir, 'xxwiki-multistream-index.txt.bz2'), 'wb') as f:
+            f.write(bz2.compress(b''.join(index)))
+        self.ranges = WikiExtractor.stream_ranges(self.path)
+
+    def scanned(self):
+        self.path, path = os.path.join(self.dir, 'dump.xml'), self.path
+        try:
+            return super(StreamSampleTest, self).scanned()
+        finally:
+            self.path = path
+
+    def indexed(self):
+        pages = WikiExtractor.sampled_streams(self.path, self.ranges, 1)
+        return [page for page in pages if page[2] not in WikiExtractor.templateKeys and
+                (WikiExtractor.sample >= 1 or WikiExtractor.sampled(page[0]))]
+
+    def test_no_index(self):
+        os.remove(os.path.join(self.dir, 'xxwiki-multistream-index.txt.bz2'))
+        WikiExtractor.sample = 0.5
+        self.assertIsNone(WikiExtractor.sampled_streams(self.path, self.ranges, 1))
+
+    def test_fraction(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = 0.3, 5
+        self.assertEqual(self.indexed(), self.scanned())
+
+    def test_count(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = 3, 5
+        scanned = self.scanned()
+        self.assertEqual(len(scanned), 3)
+        self.assertEqual(self.indexed(), scanned)
+
+    def test_count_all(self):
+        WikiExtractor.sample = 1000
+        self.assertEqual(self.indexed(), self.scanned())
+
+    def test_skip_streams(self):
+        WikiExtractor.sample, WikiExtractor.sample_seed = 0.01, 5
+        read = []
+        dump_pages = WikiExtractor.dump_pages
+
+        def counted(input_file, ranges, readers, input=None):
+            read.extend(ranges)
+            return dump_pages(input_file, ranges, readers, input)
+        WikiExtractor.dump_pages = counted
+        try:
+            self.assertEqual(self.indexed(), self.scanned())
+        finally:
+            WikiExtractor.dump_pages = dump_pages
+        self.assertLess(len(read), len(self.ranges) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import unittest
+from multiprocessing import Value
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WikiExtractor
+
+RULES = ('triageMinSize', 'triageMaxSize', 'triageDisambig', 'triageTitles',
+         'triageCategories', 'categoryNamespace')
+
+
+class TriageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(WikiExtractor, name)) for name in RULES)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(WikiExtractor, name, value)
+        WikiExtractor.triage_rules()
+
+    def rules(self, **rules):
+        for name, value in rules.items():
+            setattr(WikiExtractor, name, value)
+        WikiExtractor.triage_rules()
+
+    def test_disabled(self):
+        self.assertFalse(WikiExtractor.triage_enabled())
+        self.assertFalse(WikiExtractor.triaged('Alpha', b'', None))
+
+    def test_size(self):
+        self.rules(triageMinSize=5, triageMaxSize=10)
+        self.assertEqual(WikiExtractor.triage('A', b'1234'), 'size')
+        self.assertIsNone(WikiExtractor.triage('A', b'12345'))
+        self.assertEqual(WikiExtractor.triage('A', b'12345678901'), 'size')
+
+    def test_disambiguation(self):
+        self.rules(triageDisambig=True)
+        self.assertEqual(WikiExtractor.triage('A', b'x __DISAMBIG__'), 'disambiguation')
+        self.assertEqual(WikiExtractor.triage('A', b'{{ disambig |geo}}'), 'disambiguation')
+        self.assertEqual(WikiExtractor.triage('A', u'{{消歧義}}'.encode('utf-8')), 'disambiguation')
+        self.assertIsNone(WikiExtractor.triage('A', b'{{Disambiguated}}'))
+
+    def test_title(self):
+        self.rules(triageTitles=re.compile('^List of '))
+        self.assertEqual(WikiExtractor.triage('List of cats', b'text'), 'title')
+        self.assertIsNone(WikiExtractor.triage('Cats', b'text'))
+
+    def test_category(self):
+        self.rules(triageCategories=set(['Living people']), categoryNamespace=u'分類')
+        self.assertEqual(WikiExtractor.triage('A', b'[[Category:Living_people|A]]'), 'category')
+        self.assertEqual(WikiExtractor.triage('A', u'[[分類: living people]]'.encode('utf-8')),
+                         'category')
+        self.assertIsNone(WikiExtractor.triage('A', b'[[Category:Dead people]]'))
+
+    def test_counters(self):
+        self.rules(triageMinSize=5)
+        counters = dict((reason, Value('l', 0)) for reason in WikiExtractor.triageReasons)
+        self.assertTrue(WikiExtractor.triaged('A', b'1', counters))
+        self.assertFalse(WikiExtractor.triaged('A', b'123456', counters))
+        self.assertEqual(counters['size'].value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()